@@ -14,40 +14,40 @@
 
 
 import os
+import io
+import zlib
+import copy
+import math
 import shutil
 from os import listdir
-from os.path import join, getsize, isfile, dirname, abspath, isdir
+from os.path import join, getsize, isfile, dirname, abspath, isdir, basename
 # from fpdf import FPDF
-import PIL.Image
-import exifread
 import re
 import sys
 import json
-from reportlab.pdfgen import canvas
-from reportlab.platypus import Paragraph  # , Image, Flowable
-from reportlab.lib.styles import getSampleStyleSheet  # , ParagraphStyle
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import A4, landscape
-import reportlab.rl_config
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-# from PyQt5.QtWidgets import QApplication, QMainWindow, QTextEdit, QLineEdit
-# from PyQt5.QtGui import QIcon, QSyntaxHighlighter, QTextCharFormat, QColor
-# from PyQt5.QtCore import Qt
-from PySide2.QtWidgets import QApplication, QMainWindow, QTextEdit, QLineEdit
-from PySide2.QtGui import QIcon, QSyntaxHighlighter, QTextCharFormat, QColor
-from PySide2.QtCore import Qt
+import html
+import struct
+import hashlib
+import sqlite3
+import time
+import glob
+import argparse
+import itertools
+import functools
+import gc
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from collections import namedtuple, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+# Heavy dependencies are imported by the code that needs them, to keep the startup of the command line and of the
+# worker processes fast: PIL and exifread when images are read, reportlab when a document is drawn, ghostscript when
+# the PDF is recompressed. The Qt user interface is in gui.py, imported only when the app is launched without
+# arguments.
 # import subprocess
-import ghostscript
-import locale
-
-# os.environ['QT_MAC_WANTS_LAYER'] = '1'
-# os.environ['QT_DEBUG_PLUGINS'] = '1'
-reportlab.rl_config.warnOnMissingFontGlyphs = 0
 
 # Constants
 VERSION = '2021-08-03'
-GUI = True
 # USE_FPDF = False
 # USE_RL = True
 MACOSRED = (236, 95, 93)
@@ -59,6 +59,75 @@ MACOSBLUE = (48, 123, 246)
 MACOSMAGENTA = (154, 86, 163)
 MACOSDARK = (46, 46, 46)
 LANGUAGES = ['it', 'en', 'de', 'fr', 'es']
+CACHE_FOLDER = '.fotopdf_cache'
+CACHE_VERSION = 2
+CACHE_MAX_ENTRIES = 5000
+THUMBNAILS_MAX_BYTES = 200 * 1000000
+# Image files read from the folders, by extension. JPEG files are embedded as they are, the others are transcoded first
+# (see transcode_image()) and kept in the cache folder, up to TRANSCODED_MAX_BYTES. HEIC files require pillow-heif.
+INPUT_FORMATS = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.png': 'PNG', '.tif': 'TIFF', '.tiff': 'TIFF', '.heic': 'HEIF',
+                 '.heif': 'HEIF'}
+TRANSCODED_MAX_BYTES = 2000 * 1000000
+# JPEG quality of the transcoded photos, resampled images are encoded again with images.jpeg_quality
+TRANSCODE_QUALITY = 95
+# Images prepared (read, resampled, encoded) in parallel while the pages are drawn, and how many ahead at most
+PREPARE_WORKERS = min(4, os.cpu_count() or 1)
+PREPARE_WINDOW = 2 * PREPARE_WORKERS
+# Pages per part in streaming mode, see FotoPDF.end_page()
+STREAM_PAGES = 50
+# Documents compressed at the same time, see FotoPDF.resave_pdf()
+COMPRESS_WORKERS = min(4, os.cpu_count() or 1)
+# For each quality preset of the "output" settings: the PDFSETTINGS of Ghostscript and, for pikepdf, the JPEG quality
+# images are encoded again with and the longest side (in pixel) they are scaled down to. None keeps them as they are.
+QUALITY_PRESETS = {
+    'default': ('/default', None, None),
+    'prepress': ('/prepress', None, None),
+    'printer': ('/printer', 85, None),
+    'ebook': ('/ebook', 75, 1600),
+    'screen': ('/screen', 60, 1000),
+}
+COMPRESSIONS = ('none', 'pikepdf', 'ghostscript')
+# How the colour profiles of the images are declared in the PDF, see fix_colors()
+COLOR_FIXES = ('none', 'icc', 'output_intent')
+# PDF colour spaces of the images and the matching ICC profiles, as (components, colour space in the profile header)
+ICC_COLOR_SPACES = {'/DeviceGray': (1, b'GRAY'), '/DeviceRGB': (3, b'RGB '), '/DeviceCMYK': (4, b'CMYK')}
+# TrueType fonts of the settings, registered as font_title, font_author and font_text
+FONTS = ('title', 'author', 'text')
+# Layouts of the grid pages, see grid_layout()
+GRID_LAYOUTS = ('fixed', 'auto', 'justified')
+# Disk space for the pages kept by the incremental mode, see FotoPDF.page_plan()
+PAGES_MAX_BYTES = 1000 * 1000000
+# Part of the fingerprint of the pages, to be increased when the same settings give different pages
+PAGES_VERSION = 4
+# Text that doesn't fit its area is drawn with a smaller font, down to this fraction of its size, see fit_paragraph()
+TEXT_MIN_SCALE = 0.5
+# Laid out paragraphs kept in memory, see wrap_paragraph()
+PARAGRAPH_CACHE_SIZE = 4096
+
+# Settings added after the first versions, used when a setting file doesn't have them
+DEFAULT_SETTINGS = {
+    "images": {
+        "dpi": 200,
+        "jpeg_quality": 85
+    },
+    "fonts": {
+        "shared_subset": 0
+    },
+    "grid": {
+        "layout": "fixed",
+        "thumbnails": 1
+    },
+    "output": {
+        "compression": "none",
+        "quality": "default",
+        "color": "none",
+        "linearize": 0
+    }
+}
+
+# Everything the page builders need to know about an image, read once per folder by FotoPDF.index_images()
+ImageInfo = namedtuple('ImageInfo', ['filename', 'path', 'width', 'height', 'orientation', 'icc_profile',
+                                     'description', 'hash'])
 
 
 # Translate asset paths to usable format for PyInstaller
@@ -71,7 +140,7 @@ def resource_path(path):
     if not os.path.isabs(path):
         if hasattr(sys, '_MEIPASS'):
             return os.path.join(sys._MEIPASS, path)
-        return os.path.join(os.path.abspath('.'), path)
+        return os.path.join(dirname(abspath(__file__)), path)
     else:
         return path
 
@@ -106,13 +175,1155 @@ def longest_common_prefix(list_of_strings):
     return prefix
 
 
+# A stage of the build (or an operation on one image) and its duration, see Timings
+Timing = namedtuple('Timing', ['stage', 'image', 'seconds'])
+
+
+class Timings:
+    # Durations of the stages of the build and of the operations on each image, summed by stage. If given, on_timing
+    # is called with a Timing as soon as each one ends, from the thread that ran it (images are prepared by a pool).
+
+    def __init__(self, on_timing=None):
+        self.on_timing = on_timing
+        self.lock = threading.Lock()
+        # stage: [count, seconds]
+        self.totals = {}
+
+    @contextmanager
+    def timed(self, stage, image=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, image)
+
+    def add(self, stage, seconds, image=None):
+        # For what is timed somewhere else, i.e. in a worker process
+        with self.lock:
+            total = self.totals.setdefault(stage, [0, 0.])
+            total[0] += 1
+            total[1] += seconds
+        if self.on_timing is not None:
+            self.on_timing(Timing(stage, image, seconds))
+
+    def snapshot(self):
+        with self.lock:
+            return dict((stage, list(total)) for stage, total in self.totals.items())
+
+    def report(self, since=None):
+        # Slowest stages first, only what happened after the snapshot since if given. Stages can be nested (i.e.
+        # resample is part of prepare_image) and images are prepared in parallel, so the sum of the rows is not the
+        # duration of the build.
+        totals = self.snapshot()
+        for stage, (count, seconds) in (since or {}).items():
+            totals[stage] = [totals[stage][0] - count, totals[stage][1] - seconds]
+        lines = ["{:<16} {:>7} {:>10} {:>10}".format('stage', 'count', 'total (s)', 'mean (ms)')]
+        for stage, (count, seconds) in sorted(totals.items(), key=lambda item: -item[1][1]):
+            if count == 0:
+                continue
+            lines.append("{:<16} {:>7} {:>10.3f} {:>10.2f}".format(stage, count, seconds, seconds * 1000. / count))
+        return "\n".join(lines)
+
+
+def decode_text(data):
+    # Lightroom writes UTF-8, older software Latin-1. UTF-8 is tried first, since decoding as Latin-1 never fails.
+    data = data.rstrip(b'\0')
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return data.decode('latin-1')
+
+
+def read_exif(data):
+    # ImageDescription and Orientation from the TIFF structure of the Exif segment. Both are in the first IFD, nothing
+    # else is read: no sub-IFD, no MakerNote, no thumbnail.
+    byteorder = {b'II': '<', b'MM': '>'}.get(data[:2])
+    if byteorder is None:
+        return None, 1
+    description = None
+    orientation = 1
+    ifd = struct.unpack_from(byteorder + 'I', data, 4)[0]
+    for i in range(struct.unpack_from(byteorder + 'H', data, ifd)[0]):
+        tag, kind, count = struct.unpack_from(byteorder + 'HHI', data, ifd + 2 + i * 12)
+        value = ifd + 2 + i * 12 + 8
+        if tag == 0x010E and kind in (2, 7):
+            # ASCII (or UNDEFINED, for some software), in the entry itself if it's 4 bytes at most
+            if count > 4:
+                value = struct.unpack_from(byteorder + 'I', data, value)[0]
+            description = decode_text(data[value:value + count])
+        elif tag == 0x0112 and kind == 3:
+            orientation = struct.unpack_from(byteorder + 'H', data, value)[0]
+    return description, orientation
+
+
+def read_xmp_description(data):
+    # dc:description of the XMP packet, the default language of the rdf:Alt (or the first one)
+    match = re.search(rb'<dc:description>\s*<rdf:Alt>\s*<rdf:li[^>]*>(.*?)</rdf:li>', data, re.DOTALL)
+    if match is None:
+        return None
+    return html.unescape(match.group(1).decode('utf-8', 'replace'))
+
+
+def read_jpeg_header(f):
+    # Reads the segments of a JPEG file up to the frame header (SOF), where the compressed data begins: size, number
+    # of components, caption, orientation and ICC profile are all before it. The caption is the Exif ImageDescription
+    # or, if missing, the XMP dc:description. It returns None if f is not a JPEG file or the header is broken.
+    if f.read(2) != b'\xff\xd8':
+        return None
+    description = None
+    xmp_description = None
+    orientation = 1
+    icc_chunks = {}
+    while True:
+        marker = f.read(2)
+        # Markers can be preceded by any number of 0xff fill bytes
+        while marker[1:] == b'\xff':
+            marker = marker[1:] + f.read(1)
+        if len(marker) < 2 or marker[0] != 0xff:
+            return None
+        if marker[1] in (0x01, 0xd0, 0xd1, 0xd2, 0xd3, 0xd4, 0xd5, 0xd6, 0xd7):
+            # Markers without a segment
+            continue
+        length = f.read(2)
+        if len(length) < 2 or marker[1] in (0xd9, 0xda):
+            # End of the file or start of the compressed data without a frame header
+            return None
+        data = f.read(struct.unpack('>H', length)[0] - 2)
+
+        try:
+            if 0xc0 <= marker[1] <= 0xcf and marker[1] not in (0xc4, 0xc8, 0xcc):
+                height, width, components = struct.unpack_from('>HHB', data, 1)
+                icc_profile = b''.join(icc_chunks[i] for i in sorted(icc_chunks)) or None
+                return (width, height, components, orientation, icc_profile,
+                        description if description is not None else xmp_description)
+            elif marker[1] == 0xe1 and data.startswith(b'Exif\0\0'):
+                description, orientation = read_exif(data[6:])
+            elif marker[1] == 0xe1 and data.startswith(b'http://ns.adobe.com/xap/1.0/\0'):
+                xmp_description = read_xmp_description(data)
+            elif marker[1] == 0xe2 and data.startswith(b'ICC_PROFILE\0'):
+                # Profiles larger than a segment are split in chunks, numbered from 1
+                icc_chunks[data[12]] = data[14:]
+        except (struct.error, IndexError):
+            return None
+
+
+# Whether the optional Pillow plugins have been looked for, see open_image()
+_image_plugins = False
+
+
+def open_image(source):
+    # PIL.Image.open, also for the formats Pillow needs a plugin for
+    global _image_plugins
+    import PIL.Image
+    if not _image_plugins:
+        _image_plugins = True
+        try:
+            from pillow_heif import register_heif_opener
+            register_heif_opener()
+        except ImportError:
+            pass
+    return PIL.Image.open(source)
+
+
+def is_jpeg(path):
+    return INPUT_FORMATS.get(os.path.splitext(path)[1].lower()) == 'JPEG'
+
+
+def read_image_info(path, timings=None):
+    # A single open per image. read_jpeg_header() reads size, caption and ICC profile parsing only the first segments
+    # of the file, then the file is read once more to compute its hash. Anything but a valid JPEG file goes through
+    # Pillow and exifread (Pillow alone corrupts the accented characters of the captions), which raise an error if it's
+    # not an image at all.
+    if timings is None:
+        timings = Timings()
+    image = os.path.basename(path)
+    with open(path, 'rb') as f:
+        with timings.timed('header', image):
+            header = read_jpeg_header(f)
+        if header is not None:
+            width, height, _, orientation, icc_profile, description = header
+        else:
+            f.seek(0)
+            width, height, orientation, icc_profile, description = read_image_info_with_pil(f)
+        # Content hash, to recognize the same image under a different name or after a touch
+        f.seek(0)
+        with timings.timed('hash', image):
+            digest = hashlib.sha1()
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+
+    return ImageInfo(image, path, width, height, orientation, icc_profile, description,
+                     digest.hexdigest())
+
+
+def read_image_info_with_pil(f):
+    import logging
+    import exifread
+
+    # exifread complains about the formats without Exif data, like most PNG files
+    logging.getLogger('exifread').setLevel(logging.ERROR)
+    tags = exifread.process_file(f, details=False)
+    f.seek(0)
+    with open_image(f) as im:
+        width, height = im.size
+        icc_profile = im.info.get('icc_profile')
+        # PNG and TIFF files have the XMP packet here
+        xmp = im.info.get('XML:com.adobe.xmp') or im.info.get('xmp')
+    description = str(tags['Image ImageDescription']) if 'Image ImageDescription' in tags else None
+    if description is None and xmp:
+        description = read_xmp_description(xmp.encode('utf-8') if isinstance(xmp, str) else xmp)
+    try:
+        orientation = int(tags['Image Orientation'].values[0])
+    except (KeyError, IndexError, ValueError):
+        orientation = 1
+    return width, height, orientation, icc_profile, description
+
+
+# Reported after each page by FotoPDF.end_page(), see FotoPDF.progress
+Progress = namedtuple('Progress', ['document', 'pages_done', 'pages_total', 'image', 'bytes_written'])
+
+
+class BuildCancelled(Exception):
+    # Raised at the end of a page when FotoPDF.cancel() has been called
+    pass
+
+
+class MetadataCache:
+    # Sidecar SQLite cache stored in the input folder. Entries are keyed by (filename, size, mtime) so that only the
+    # images that changed since the last run are read again. The least recently used entries are evicted beyond
+    # max_entries.
+
+    def __init__(self, input_folder, max_entries=CACHE_MAX_ENTRIES):
+        self.input_folder = input_folder
+        self.max_entries = max_entries
+        os.makedirs(join(input_folder, CACHE_FOLDER), exist_ok=True)
+        self.db = sqlite3.connect(join(input_folder, CACHE_FOLDER, 'metadata.sqlite'), timeout=30)
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != CACHE_VERSION:
+            self.db.execute('DROP TABLE IF EXISTS images')
+            self.db.execute('PRAGMA user_version = {}'.format(CACHE_VERSION))
+        self.db.execute('CREATE TABLE IF NOT EXISTS images ('
+                        'filename TEXT, size INTEGER, mtime INTEGER, '
+                        'width INTEGER, height INTEGER, orientation INTEGER, icc_profile BLOB, description TEXT, '
+                        'hash TEXT, last_used REAL, '
+                        'PRIMARY KEY (filename, size, mtime))')
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filename, timings=None):
+        # Returns the cached ImageInfo, reading the image only if it's new or it changed
+        path = join(self.input_folder, filename)
+        st = os.stat(path)
+        key = (filename, st.st_size, st.st_mtime_ns)
+        row = self.db.execute('SELECT width, height, orientation, icc_profile, description, hash FROM images '
+                              'WHERE filename = ? AND size = ? AND mtime = ?', key).fetchone()
+        if row is not None:
+            self.hits += 1
+            self.db.execute('UPDATE images SET last_used = ? WHERE filename = ? AND size = ? AND mtime = ?',
+                            (time.time(),) + key)
+            width, height, orientation, icc_profile, description, digest = row
+            return ImageInfo(filename, path, width, height, orientation,
+                             bytes(icc_profile) if icc_profile is not None else None, description, digest)
+
+        self.misses += 1
+        info = read_image_info(path, timings)
+        # Older versions of the same file are useless from now on
+        self.db.execute('DELETE FROM images WHERE filename = ?', (filename,))
+        self.db.execute('INSERT INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        key + (info.width, info.height, info.orientation, info.icc_profile, info.description,
+                               info.hash, time.time()))
+        return info
+
+    def close(self):
+        self.db.execute('DELETE FROM images WHERE rowid NOT IN '
+                        '(SELECT rowid FROM images ORDER BY last_used DESC LIMIT ?)', (self.max_entries,))
+        self.db.commit()
+        self.db.close()
+
+
+def resample_image(path, size, quality):
+    # Scales the image down to size (width, height), as data ready for the PDF with its extension, like
+    # transcode_image(): photos are encoded again as JPEG keeping the ICC profile, graphics (see is_graphic()) become
+    # zlib compressed RGB pixels, so they stay lossless.
+    import PIL.Image
+
+    with open_image(path) as im:
+        if is_graphic(im):
+            return zlib.compress(flatten_image(im).resize(size, PIL.Image.LANCZOS).tobytes()), '.flate'
+        icc_profile = im.info.get('icc_profile')
+        # For JPEG files, draft lets the decoder scale by 1/2, 1/4 or 1/8 while decoding, much faster than decoding
+        # the full image and resizing it afterwards. The result is never smaller than size.
+        im.draft(im.mode, size)
+        resampled = eight_bit_image(im).resize(size, PIL.Image.LANCZOS)
+    if resampled.mode not in ('RGB', 'L', 'CMYK'):
+        resampled, icc_profile = rgb_image(resampled, icc_profile)
+
+    output = io.BytesIO()
+    if icc_profile:
+        resampled.save(output, 'JPEG', quality=quality, optimize=True, icc_profile=icc_profile)
+    else:
+        resampled.save(output, 'JPEG', quality=quality, optimize=True)
+    return output.getvalue(), '.jpg'
+
+
+def is_graphic(im):
+    # Bilevel, with a palette or with transparency, like drawings and screenshots
+    return im.mode in ('1', 'P', 'PA', 'LA', 'RGBA') or 'transparency' in im.info
+
+
+def flatten_image(im):
+    # RGB copy of a graphic, with the transparent areas white
+    import PIL.Image
+
+    im = im.convert('RGBA')
+    flat = PIL.Image.new('RGB', im.size, (255, 255, 255))
+    flat.paste(im, mask=im.getchannel('A'))
+    return flat
+
+
+def eight_bit_image(im):
+    # 16 bit grayscale (i.e. scans) scaled to 8 bit, converting it to RGB would saturate it. Other images are returned
+    # as they are.
+    if im.mode.startswith('I;16'):
+        return im.convert('I').point(lambda value: value * (1 / 256.)).convert('L')
+    return im
+
+
+def rgb_image(im, icc_profile):
+    # im converted to RGB, with the ICC profile of the result. The profile of another colour space (i.e. CMYK or LAB)
+    # doesn't describe RGB pixels, so the conversion goes through it to sRGB, the colour space of the images without a
+    # profile. Without a usable profile, the pixels are converted as they are and there's no profile either.
+    import PIL.ImageCms
+
+    if icc_profile or im.mode == 'LAB':
+        try:
+            source = (PIL.ImageCms.ImageCmsProfile(io.BytesIO(icc_profile)) if icc_profile
+                      else PIL.ImageCms.createProfile('LAB'))
+            return PIL.ImageCms.profileToProfile(im, source, PIL.ImageCms.createProfile('sRGB'), outputMode='RGB'), None
+        except (PIL.ImageCms.PyCMSError, OSError, ValueError):
+            pass
+    return im.convert('RGB'), None
+
+
+def transcode_image(path, quality=TRANSCODE_QUALITY):
+    # An image that is not a JPEG file as data ready for the PDF, with the extension of its cache file. Photos become
+    # JPEG files (DCTDecode, embedded as they are by load_jpeg_xobject()) keeping the ICC profile. Graphics (see
+    # is_graphic()) become zlib compressed RGB pixels (FlateDecode, see load_flate_xobject()), so they stay lossless.
+    with open_image(path) as im:
+        im.load()
+        icc_profile = im.info.get('icc_profile')
+        if is_graphic(im):
+            return zlib.compress(flatten_image(im).tobytes()), '.flate'
+        im = eight_bit_image(im)
+        if im.mode not in ('RGB', 'L'):
+            im, icc_profile = rgb_image(im, icc_profile)
+        output = io.BytesIO()
+        if icc_profile:
+            im.save(output, 'JPEG', quality=quality, icc_profile=icc_profile)
+        else:
+            im.save(output, 'JPEG', quality=quality)
+    return output.getvalue(), '.jpg'
+
+
+def load_flate_xobject(xobject, data, width, height):
+    # The RGB pixels of transcode_image() become the image stream as they are
+    xobject.width, xobject.height = width, height
+    xobject.bitsPerComponent = 8
+    xobject.colorSpace = 'DeviceRGB'
+    xobject.streamContent = data
+    xobject._filters = ('FlateDecode',)
+    xobject.mask = None
+
+
+def write_cache_file(path, data):
+    # Written under a temporary name and renamed, since other processes might be reading it. Errors are ignored, the
+    # file is created again next time.
+    try:
+        os.makedirs(dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
+def load_jpeg_xobject(xobject, data):
+    # The JPEG data becomes the image stream as it is (DCTDecode), only the header is parsed: no pixel is decoded and,
+    # unlike reportlab's loadImageFromJPEG, it's not ASCII85 encoded, which makes it 25% larger and costs a pass over
+    # the data. The ICC profile stays in the JPEG data. It returns False if data is not a JPEG file.
+    from reportlab.pdfbase import pdfutils
+
+    try:
+        width, height, components = pdfutils.readJPEGInfo(io.BytesIO(data))[:3]
+    except Exception:
+        # reportlab raises PDFError, or whatever the broken header causes
+        return False
+    xobject.width, xobject.height = width, height
+    xobject.bitsPerComponent = 8
+    if components == 1:
+        xobject.colorSpace = 'DeviceGray'
+    elif components == 3:
+        xobject.colorSpace = 'DeviceRGB'
+    else:
+        # CMYK JPEG files are written inverted by Photoshop, like reportlab does
+        xobject.colorSpace = 'DeviceCMYK'
+        xobject._dotrans = 1
+    xobject.streamContent = data
+    xobject._filters = ('DCTDecode',)
+    xobject.mask = None
+    return True
+
+
+def trim_folder(folder, max_bytes, keep=()):
+    # Deletes the least recently modified files of folder beyond max_bytes. The files named in keep are never deleted
+    # and are the first to count against max_bytes.
+    if not isdir(folder):
+        return
+    files = []
+    for f in listdir(folder):
+        st = os.stat(join(folder, f))
+        files.append((f in keep, st.st_mtime, st.st_size, f))
+    files.sort(reverse=True)
+    total = 0
+    for kept, mtime, size, f in files:
+        total += size
+        if total > max_bytes and not kept:
+            os.remove(join(folder, f))
+
+
+def file_signature(path):
+    # Identifies a version of a file without reading it
+    try:
+        st = os.stat(path)
+        return [abspath(path), st.st_size, st.st_mtime_ns]
+    except OSError:
+        return [abspath(path)]
+
+
+def fingerprint(*inputs):
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# TrueType files already parsed by this process, by path and modification time, and the fonts registered with them,
+# see load_font()
+_font_faces = {}
+_fonts = {}
+
+
+def load_font(name, path):
+    # Registers a TrueType font. Each file is parsed only the first time or when it changes, whatever the names it's
+    # registered with (the same file is often the title, author and text font): long-running processes (batches, the
+    # watch mode and its workers) build many documents with the same fonts
+    from weakref import WeakKeyDictionary
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    path = abspath(path)
+    key = (path, os.stat(path).st_mtime_ns)
+    if (name,) + key not in _fonts:
+        if key not in _font_faces:
+            _font_faces[key] = TTFont(name, path)
+        # Besides the parsed file, a font only holds the subsets of the documents being written: copies with another
+        # name share the file
+        font = copy.copy(_font_faces[key])
+        font.fontName = name
+        font.state = WeakKeyDictionary()
+        _fonts[(name,) + key] = font
+    pdfmetrics.registerFont(_fonts[(name,) + key])
+    return _fonts[(name,) + key]
+
+
+# Paragraph styles already created, see paragraph_style()
+_paragraph_styles = {}
+
+
+def paragraph_style(font, size, leading, black, alignment):
+    # Styles by font, size, leading, colour and alignment (0 left, 1 center, 2 right, 4 justify). Each call of
+    # getSampleStyleSheet() creates all the styles again.
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.lib import colors
+    key = (font, size, leading, black, alignment)
+    if key not in _paragraph_styles:
+        _paragraph_styles[key] = ParagraphStyle('text{}'.format(len(_paragraph_styles)),
+                                                parent=getSampleStyleSheet()['BodyText'],
+                                                fontName=font,
+                                                fontSize=size,
+                                                leading=leading,
+                                                alignment=alignment,
+                                                textColor=colors.black if black else colors.white)
+    return _paragraph_styles[key]
+
+
+@functools.lru_cache(maxsize=PARAGRAPH_CACHE_SIZE)
+def wrap_paragraph(text, font, size, interline, black, alignment, width, height):
+    # The paragraph laid out in width x height, with its size. font is the registered font and not its name, as
+    # different settings register different files with the same name.
+    from reportlab.platypus import Paragraph
+    paragraph = Paragraph(text, paragraph_style(font.fontName, size, size + interline, black, alignment))
+    text_w, text_h = paragraph.wrap(width, height)
+    return paragraph, text_w, text_h
+
+
+def fit_paragraph(text, font, size, interline, black, alignment, width, height):
+    # The paragraph with the largest font size, between TEXT_MIN_SCALE * size and size in steps of half a point, that
+    # fits in width x height, as (paragraph, height, size). None if it doesn't fit even with the smallest one.
+    def fits(half_points):
+        paragraph, text_w, text_h = wrap_paragraph(text, font, half_points / 2., interline, black, alignment, width,
+                                                   height)
+        return paragraph if text_w <= width and text_h <= height else None
+
+    paragraph = fits(size * 2)
+    if paragraph is not None:
+        return paragraph, paragraph.height, size
+    # Bisection, a few wraps at most
+    low, high = int(math.ceil(size * TEXT_MIN_SCALE * 2)), int(math.ceil(size * 2)) - 1
+    if low > high or fits(low) is None:
+        return None
+    while low < high:
+        middle = (low + high + 1) // 2
+        if fits(middle) is not None:
+            low = middle
+        else:
+            high = middle - 1
+    paragraph = fits(low)
+    return paragraph, paragraph.height, low / 2.
+
+
+def best_grid(count, width, height, h_margin, v_margin, ratio):
+    # Rows and columns of the grid with the largest cells of the given ratio (width / height) that holds count cells
+    # in width x height, with the size of the cells. All the numbers of columns are tried at once.
+    import numpy as np
+    columns = np.arange(1, count + 1)
+    rows = np.ceil(count / columns)
+    cell_w = np.minimum((width - (columns - 1) * h_margin) / columns, (height - (rows - 1) * v_margin) / rows * ratio)
+    best = int(np.argmax(cell_w))
+    return int(rows[best]), int(columns[best]), float(cell_w[best]), float(cell_w[best] / ratio)
+
+
+def grid_layout(ratios, page_w, page_h, layout, rows, columns, h_margin, v_margin, lateral_margin, block_ratio):
+    # Images with the given ratios (width / height) laid out on one or more pages, as a list with an array of
+    # (image, x, y, width, height) for each page. Coordinates are the bottom left corner of each image, as drawn by
+    # reportlab. With layout:
+    # - fixed: cells of ratio block_ratio, rows x columns of them on each page
+    # - auto: the grid with the largest cells of ratio block_ratio for the images of each page, up to rows x columns
+    # - justified: rows of images as wide as the page, each row about as high as one of rows rows
+    import numpy as np
+    ratios = np.asarray(ratios, dtype=float)
+    count = len(ratios)
+    if count == 0:
+        return []
+    if layout == 'justified':
+        return justified_layout(ratios, page_w, page_h, rows, h_margin, v_margin, lateral_margin)
+
+    if layout == 'auto':
+        # As many images on each page, rather than full pages and the rest on the last one
+        per_page = int(math.ceil(count / math.ceil(count / float(rows * columns))))
+        rows, columns, cell_w, cell_h = best_grid(per_page, page_w - 2 * lateral_margin, page_h - 2 * lateral_margin,
+                                                  h_margin, v_margin, block_ratio)
+    else:
+        per_page = rows * columns
+        # Starting from columns and checking if the total height is within the margins
+        cell_w = (page_w - 2 * lateral_margin - (columns - 1) * h_margin) / columns
+        cell_h = cell_w / block_ratio
+        # Too high, restarting from rows
+        if rows * cell_h + (rows - 1) * v_margin + lateral_margin > page_h:
+            cell_h = (page_h - 2 * lateral_margin - (rows - 1) * v_margin) / rows
+            cell_w = cell_h * block_ratio
+
+    index = np.arange(count)
+    position = index % per_page
+    cell_x = (page_w - (columns * cell_w + (columns - 1) * h_margin)) / 2 + (position % columns) * (cell_w + h_margin)
+    cell_y = page_h - cell_h - ((page_h - (rows * cell_h + (rows - 1) * v_margin)) / 2 +
+                                (position // columns) * (cell_h + v_margin))
+    # Each image as large as possible and centered in its cell, like FotoPDF.fit_image()
+    image_h = np.minimum(cell_h, cell_w / ratios)
+    image_w = image_h * ratios
+    cells = np.column_stack((index, cell_x + (cell_w - image_w) / 2, cell_y + (cell_h - image_h) / 2, image_w, image_h))
+    return np.split(cells, np.arange(per_page, count, per_page))
+
+
+def justified_layout(ratios, page_w, page_h, rows, h_margin, v_margin, lateral_margin):
+    # See grid_layout(). Images are added to a row until, stretched to the width of the page, it's not higher than a
+    # row of the grid. The last row is not stretched. Rows are then put on pages from the top.
+    import numpy as np
+    count = len(ratios)
+    area_w = page_w - 2 * lateral_margin
+    area_h = page_h - 2 * lateral_margin
+    row_height = (area_h - (rows - 1) * v_margin) / rows
+
+    # Images from i to j (excluded) stretched to area_w are (area_w - (j - i - 1) * h_margin) / (sums[j] - sums[i])
+    # high, which is not more than row_height from the first j with ends[j] >= ends[i] + area_w + h_margin
+    sums = np.concatenate(([0.], np.cumsum(ratios)))
+    ends = sums * row_height + np.arange(count + 1) * h_margin
+    next_start = np.maximum(np.searchsorted(ends, ends + area_w + h_margin), np.arange(1, count + 2))
+    starts = [0]
+    while starts[-1] < count:
+        starts.append(min(int(next_start[starts[-1]]), count))
+    starts, stops = np.array(starts[:-1]), np.array(starts[1:])
+    heights = np.minimum((area_w - (stops - starts - 1) * h_margin) / (sums[stops] - sums[starts]), row_height)
+
+    # Pages and distance of each row from the top of its page
+    row_page, row_top = np.zeros(len(heights), dtype=int), np.zeros(len(heights))
+    page, top = 0, 0.
+    for row, height in enumerate(heights):
+        if top > 0 and top + height > area_h:
+            page, top = page + 1, 0.
+        row_page[row], row_top[row] = page, top
+        top += height + v_margin
+    # Rows are centered on the page
+    page_height = np.zeros(page + 1)
+    np.maximum.at(page_height, row_page, row_top + heights)
+    row_top += lateral_margin + (area_h - page_height[row_page]) / 2
+
+    # Images of a row one after the other, centered on the page (only the last row is narrower)
+    image_row = np.repeat(np.arange(len(heights)), stops - starts)
+    image_h = heights[image_row]
+    image_w = ratios * image_h
+    right = np.cumsum(image_w + h_margin)
+    row_left = np.concatenate(([0.], right))[starts]
+    row_width = right[stops - 1] - row_left - h_margin
+    x = right - image_w - h_margin - row_left[image_row] + lateral_margin + (area_w - row_width[image_row]) / 2
+    y = page_h - row_top[image_row] - image_h
+    cells = np.column_stack((np.arange(count), x, y, image_w, image_h))
+    return np.split(cells, np.searchsorted(row_page[image_row], np.arange(1, page + 1)))
+
+
+def ghostscript_compress(input_filename, output_filename, quality):
+    import ghostscript
+    import locale
+
+    args = ['gs', '-sDEVICE=pdfwrite',
+            '-dCompatibilityLevel=1.4',
+            '-dPDFSETTINGS={}'.format(QUALITY_PRESETS[quality][0]),
+            '-dNOPAUSE',
+            '-dQUIET',
+            '-dBATCH',
+            '-dColorAccuracy=2',
+            '-dProcessColorModel=/DeviceRGB',
+            '-sOutputFile={}'.format(output_filename),
+            input_filename]
+
+    # '-sDefaultRGBProfile=sRGB_v4_ICC_preference.icc',
+    # '-sOutputICCProfile=sRGB_v4_ICC_preference.icc',
+    # '-sImageICCProfile=sRGB_v4_ICC_preference.icc',
+
+    # Using python ghostscript module
+    encoding = locale.getpreferredencoding()
+    args = [a.encode(encoding) for a in args]
+    ghostscript.Ghostscript(*args)
+
+    # Calling ghoscript directly
+    # subprocess.call(args)
+
+
+def pikepdf_compress(input_filename, output_filename, quality, linearize=False):
+    # Lossless unless the preset says otherwise: objects are packed in compressed object streams, then JPEG images are
+    # encoded again (and scaled down) only if the preset asks for it and the result is smaller
+    import pikepdf
+
+    _, jpeg_quality, max_side = QUALITY_PRESETS[quality]
+    with pikepdf.open(input_filename) as pdf:
+        if jpeg_quality is not None:
+            for obj in pdf.objects:
+                if isinstance(obj, pikepdf.Stream) and obj.get('/Subtype') == '/Image':
+                    recompress_image(obj, jpeg_quality, max_side)
+        pdf.save(output_filename, compress_streams=True, object_stream_mode=pikepdf.ObjectStreamMode.generate,
+                 linearize=linearize)
+
+
+def linearize_pdf(input_filename, output_filename):
+    # Fast web view: the objects of the first page come first, with the hints to find the others, so viewers show it
+    # before the whole file is downloaded. Everything else is lossless, as pikepdf_compress() with the default preset.
+    pikepdf_compress(input_filename, output_filename, 'default', linearize=True)
+
+
+def recompress_image(obj, jpeg_quality, max_side):
+    import PIL.Image
+    import pikepdf
+
+    filters = obj.get('/Filter')
+    filters = [filters] if isinstance(filters, pikepdf.Name) else list(filters or [])
+    space = obj.get('/ColorSpace')
+    # The ICCBased colour spaces of fix_colors() have the profile of the JPEG data, which is kept
+    if isinstance(space, pikepdf.Array) and len(space) == 2 and space[0] == '/ICCBased':
+        space = space[1].get('/Alternate')
+    if len(filters) == 0 or filters[-1] != '/DCTDecode' or space not in ('/DeviceRGB', '/DeviceGray'):
+        return
+    im = pikepdf.PdfImage(obj).as_pil_image()
+    # The ICC profile embedded in the JPEG data is what keeps the colours right, see resample_image()
+    icc_profile = im.info.get('icc_profile')
+    if max_side is not None and max(im.size) > max_side:
+        scale = max_side / float(max(im.size))
+        im = im.resize((max(1, int(im.size[0] * scale)), max(1, int(im.size[1] * scale))), PIL.Image.LANCZOS)
+    output = io.BytesIO()
+    if icc_profile:
+        im.save(output, 'JPEG', quality=jpeg_quality, optimize=True, icc_profile=icc_profile)
+    else:
+        im.save(output, 'JPEG', quality=jpeg_quality, optimize=True)
+    if len(output.getvalue()) < len(obj.read_raw_bytes()):
+        obj.write(output.getvalue(), filter=pikepdf.Name.DCTDecode)
+        obj.Width, obj.Height = im.size
+
+
+def compress_pdf(compression, quality, input_filename, output_filename, linearize=False):
+    # Runs in a worker process, one per document, since compressing is slow and Ghostscript allows only one instance per
+    # process. input_filename is removed, if compression fails or the result is not smaller it's used as the output,
+    # linearized anyway if asked. It returns the size before and after, if something failed the error (the output is
+    # there in any case) and how long it took, recorded as the compress stage by the caller.
+    start = time.perf_counter()
+    size = getsize(input_filename)
+    errors = []
+    compressed = False
+    if compression != 'none':
+        try:
+            if compression == 'ghostscript':
+                ghostscript_compress(input_filename, output_filename, quality)
+            elif compression == 'pikepdf':
+                pikepdf_compress(input_filename, output_filename, quality, linearize=linearize)
+            else:
+                raise ValueError("unknown compression \"{}\"".format(compression))
+            compressed = isfile(output_filename) and getsize(output_filename) < size
+        except Exception as e:
+            # Whatever the backend raises, the uncompressed PDF is still good
+            errors.append("cannot compress with {} ({}: {})".format(compression, type(e).__name__, e))
+    if compressed:
+        os.remove(input_filename)
+    else:
+        os.replace(input_filename, output_filename)
+    # pikepdf linearizes while compressing, Ghostscript doesn't
+    if linearize and not (compressed and compression == 'pikepdf'):
+        try:
+            linearize_pdf(output_filename, output_filename + '.linear')
+            os.replace(output_filename + '.linear', output_filename)
+        except Exception as e:
+            errors.append("cannot linearize ({}: {})".format(type(e).__name__, e))
+    return size, getsize(output_filename), ", ".join(errors) or None, time.perf_counter() - start
+
+
+def seed_icc_profile():
+    # The sRGB profile of seed.pdf, for the images without a profile
+    import pikepdf
+    with pikepdf.open(resource_path('seed.pdf')) as seed:
+        return seed.pages[0].Resources.ColorSpace.Cs1[1].read_bytes()
+
+
+def fix_colors(filename, color):
+    # macOS Preview ignores the ICC profile in the JPEG data and shows sRGB images oversaturated, so the profiles are
+    # declared in the PDF as well, with color:
+    # - icc: each image gets the ICCBased colour space of its profile (sRGB if it has none), one for each profile
+    # - output_intent: the document gets an sRGB output intent, which applies to all the images without a profile
+    # Only dictionaries change: image data is copied as it is, neither decoded nor encoded again.
+    import pikepdf
+    from pikepdf import Name
+
+    pdf = pikepdf.open(filename)
+    try:
+        if color == 'output_intent':
+            intent = pikepdf.Dictionary(Type=Name.OutputIntent, S=Name.GTS_PDFA1,
+                                        OutputConditionIdentifier=pikepdf.String('sRGB IEC61966-2.1'),
+                                        DestOutputProfile=pdf.make_stream(seed_icc_profile(), N=3))
+            pdf.Root.OutputIntents = pikepdf.Array([pdf.make_indirect(intent)])
+        else:
+            default_profile = seed_icc_profile()
+            spaces = {}
+            images = set()
+            for page in pdf.pages:
+                for image in page.Resources.get('/XObject', {}).values():
+                    if image.get('/Subtype') != '/Image' or image.objgen in images:
+                        continue
+                    images.add(image.objgen)
+                    space = image.get('/ColorSpace')
+                    if not isinstance(space, Name) or str(space) not in ICC_COLOR_SPACES:
+                        continue
+                    components, profile_space = ICC_COLOR_SPACES[str(space)]
+                    # JPEG data is a JPEG file, its header has the profile
+                    profile = None
+                    filters = image.get('/Filter')
+                    if isinstance(filters, Name):
+                        filters = [filters]
+                    if filters is not None and list(filters) == [Name.DCTDecode]:
+                        header = read_jpeg_header(io.BytesIO(image.read_raw_bytes()))
+                        profile = header[4] if header is not None else None
+                    if profile is None or profile[16:20] != profile_space:
+                        if components != 3:
+                            continue
+                        profile = default_profile
+                    key = hashlib.sha1(profile).hexdigest()
+                    if key not in spaces:
+                        spaces[key] = pdf.make_indirect(pikepdf.Array([Name.ICCBased, pdf.make_stream(
+                            profile, N=components, Alternate=space)]))
+                    image.ColorSpace = spaces[key]
+        pdf.save(filename + '.color')
+    finally:
+        pdf.close()
+    os.replace(filename + '.color', filename)
+
+
+# Attributes a page can take from the page tree, see MergedPdfWriter.write_page()
+INHERITED_PAGE_ATTRIBUTES = ('/Resources', '/MediaBox', '/CropBox', '/Rotate')
+
+
+class MergedPdfWriter:
+    # Writes a PDF with the pages of other PDF files, one file at a time: the objects a page uses are written to the
+    # output as soon as they are found, streams copied as they are (neither decoded nor encoded again, but those without
+    # a filter, which are compressed). Memory and open files don't depend on the number of files, unlike merging with
+    # pikepdf, which copies the pages into a document kept in memory until it's saved.
+    # Each part embeds the images it uses, so an image drawn in more than one part (i.e. the cover image, also on its
+    # slide) is there more than once. Streams with the same data and dictionary are written once. The same goes for the
+    # fonts: with a shared subset (see FotoPDF.new_canvas()) all the parts embed the same font files.
+
+    def __init__(self, f):
+        self.f = f
+        self.offsets = [None]
+        self.catalog = self.reserve()
+        self.page_tree = self.reserve()
+        self.kids = []
+        self.info = None
+        # Numbers of the objects of the file being copied, by objgen, and of the streams written, by content
+        self.numbers = {}
+        self.streams = {}
+        self.pending = deque()
+
+    def reserve(self):
+        self.offsets.append(None)
+        return len(self.offsets) - 1
+
+    def add(self, pdf):
+        # Copies the pages of a pikepdf.Pdf, and its document information if it's the first one
+        if self.f.tell() == 0:
+            self.f.write('%PDF-{}\n%\xe2\xe3\xcf\xd3\n'.format(pdf.pdf_version).encode('latin-1'))
+        self.numbers = {}
+        if self.info is None and '/Info' in pdf.trailer:
+            self.info = self.number(pdf.trailer.Info)
+        for page in pdf.pages:
+            self.kids.append(self.reserve())
+            self.write_page(self.kids[-1], page.obj)
+            while len(self.pending) > 0:
+                self.write_object(*self.pending.popleft())
+
+    def close(self):
+        self.begin_object(self.page_tree)
+        self.f.write(b'<< /Type /Pages /Count %d /Kids [' % len(self.kids))
+        self.f.write(b' '.join(b'%d 0 R' % kid for kid in self.kids))
+        self.f.write(b'] >>\nendobj\n')
+        self.begin_object(self.catalog)
+        self.f.write(b'<< /Type /Catalog /Pages %d 0 R >>\nendobj\n' % self.page_tree)
+        xref = self.f.tell()
+        self.f.write(b'xref\n0 %d\n0000000000 65535 f \n' % len(self.offsets))
+        self.f.write(b''.join(b'%010d 00000 n \n' % offset for offset in self.offsets[1:]))
+        self.f.write(b'trailer\n<< /Size %d /Root %d 0 R' % (len(self.offsets), self.catalog))
+        if self.info is not None:
+            self.f.write(b' /Info %d 0 R' % self.info)
+        self.f.write(b' >>\nstartxref\n%d\n%%%%EOF\n' % xref)
+
+    def begin_object(self, number):
+        self.offsets[number] = self.f.tell()
+        self.f.write(b'%d 0 obj\n' % number)
+
+    def write_page(self, number, page):
+        # The page with the attributes it inherits, in the page tree of the output
+        attributes = {key: value for key, value in page.items() if key != '/Parent'}
+        parent = page.get('/Parent')
+        while parent is not None:
+            for key in INHERITED_PAGE_ATTRIBUTES:
+                if key not in attributes and key in parent:
+                    attributes[key] = parent[key]
+            parent = parent.get('/Parent')
+        attributes['/Parent'] = b'%d 0 R' % self.page_tree
+        self.begin_object(number)
+        self.f.write(self.serialize_dictionary(attributes) + b'\nendobj\n')
+
+    def number(self, obj):
+        # The number of an indirect object in the output. It's written later, see add().
+        import pikepdf
+
+        if obj.objgen not in self.numbers:
+            key = None
+            if obj._type_code == pikepdf.ObjectType.stream and self.is_direct(obj.stream_dict):
+                key = (hashlib.sha1(obj.read_raw_bytes()).hexdigest(), obj.stream_dict.unparse())
+            if key is not None and key in self.streams:
+                self.numbers[obj.objgen] = self.streams[key]
+            else:
+                self.numbers[obj.objgen] = self.reserve()
+                if key is not None:
+                    self.streams[key] = self.numbers[obj.objgen]
+                self.pending.append((self.numbers[obj.objgen], obj))
+        return self.numbers[obj.objgen]
+
+    def write_object(self, number, obj):
+        import pikepdf
+
+        self.begin_object(number)
+        if obj._type_code == pikepdf.ObjectType.stream:
+            data = obj.read_raw_bytes()
+            attributes = dict(obj.stream_dict.items())
+            if '/Filter' not in attributes:
+                data = zlib.compress(data)
+                attributes['/Filter'] = pikepdf.Name.FlateDecode
+                attributes.pop('/DecodeParms', None)
+            attributes['/Length'] = len(data)
+            self.f.write(self.serialize_dictionary(attributes))
+            self.f.write(b'\nstream\n')
+            self.f.write(data)
+            self.f.write(b'\nendstream\nendobj\n')
+        else:
+            self.f.write(self.serialize(obj, top=True) + b'\nendobj\n')
+
+    def is_direct(self, obj):
+        # True if obj doesn't refer to other objects
+        import pikepdf
+
+        if isinstance(obj, pikepdf.Object) and obj.is_indirect:
+            return False
+        if isinstance(obj, pikepdf.Object) and obj._type_code == pikepdf.ObjectType.dictionary:
+            return all(self.is_direct(value) for value in obj.values())
+        if isinstance(obj, pikepdf.Object) and obj._type_code == pikepdf.ObjectType.array:
+            return all(self.is_direct(value) for value in obj)
+        return True
+
+    def serialize_dictionary(self, attributes):
+        import pikepdf
+
+        return b'<<' + b''.join(pikepdf.Name(key).unparse() + b' ' + self.serialize(value) + b'\n'
+                                for key, value in attributes.items()) + b'>>'
+
+    def serialize(self, obj, top=False):
+        # obj as PDF syntax, with references to the numbers of the output. bytes are already PDF syntax.
+        import pikepdf
+
+        if isinstance(obj, bytes):
+            return obj
+        if isinstance(obj, bool):
+            return b'true' if obj else b'false'
+        if isinstance(obj, int):
+            return b'%d' % obj
+        if obj is None:
+            return b'null'
+        if not isinstance(obj, pikepdf.Object):
+            # Real numbers are Decimal
+            return '{:f}'.format(obj).encode('ascii')
+        if obj.is_indirect and not top:
+            return b'%d 0 R' % self.number(obj)
+        if obj._type_code == pikepdf.ObjectType.dictionary:
+            return self.serialize_dictionary(obj)
+        if obj._type_code == pikepdf.ObjectType.array:
+            return b'[' + b' '.join(self.serialize(value) for value in obj) + b']'
+        return obj.unparse()
+
+
+def merge_pdf_parts(parts, output_filename):
+    # Concatenates the pages of the PDF files in parts, see MergedPdfWriter
+    import pikepdf
+
+    with open(output_filename, 'wb') as f:
+        writer = MergedPdfWriter(f)
+        for part in parts:
+            with pikepdf.open(part) as pdf:
+                writer.add(pdf)
+        writer.close()
+
+
+def merge_defaults(obj, defaults):
+    # Adds to obj the keys of defaults it doesn't have, recursively
+    for key, value in defaults.items():
+        if key not in obj:
+            obj[key] = copy.deepcopy(value)
+        elif isinstance(value, dict) and isinstance(obj[key], dict):
+            merge_defaults(obj[key], value)
+    return obj
+
+
+class ImageStore:
+    # Image XObjects prepared once and shared by all the documents of a build: with several setting files (i.e. one
+    # per language) the JPEG data is read and encoded only once instead of once per document. Images can be resampled
+    # to a (width, height) in pixel, each size is a different XObject. Resampled images marked as persistent (the grid
+    # thumbnails) are also kept in cache_folder, so they are generated only once across runs. Images that are not JPEG
+    # files are transcoded once and kept in transcoded_folder.
+
+    def __init__(self, cache_folder=None, max_cache_bytes=THUMBNAILS_MAX_BYTES, timings=None, transcoded_folder=None,
+                 max_transcoded_bytes=TRANSCODED_MAX_BYTES):
+        self.xobjects = {}
+        self.cache_folder = cache_folder
+        self.max_cache_bytes = max_cache_bytes
+        self.transcoded_folder = transcoded_folder
+        self.max_transcoded_bytes = max_transcoded_bytes
+        self.timings = timings if timings is not None else Timings()
+        # Problems with the images, to be shown by the document being drawn, see take_messages()
+        self.messages = deque()
+
+    def xobject(self, info, size=None, quality=None, persistent=False):
+        # Keyed by content, so the same image under different names is embedded once. None if the image cannot be
+        # read (i.e. a truncated file): a JPEG file that cannot be resampled is embedded as it is instead.
+        key = (info.hash, size, quality)
+        if key not in self.xobjects:
+            from reportlab.pdfbase import pdfdoc
+            with self.timings.timed('prepare_image', info.filename):
+                name = hashlib.md5(repr(key).encode('utf-8')).hexdigest()
+                xobject = pdfdoc.PDFImageXObject(name)
+                try:
+                    extension = '.jpg'
+                    if size is None and not is_jpeg(info.path):
+                        data, extension = self.transcoded(info)
+                    elif size is None:
+                        with open(info.path, 'rb') as f:
+                            data = f.read()
+                    elif persistent and self.cache_folder is not None:
+                        data, extension = self.cached_resample(info, size, quality)
+                    else:
+                        data, extension = self.resample(info, size, quality)
+                    if extension == '.flate':
+                        load_flate_xobject(xobject, data, *(size or (info.width, info.height)))
+                    elif not load_jpeg_xobject(xobject, data):
+                        # Not a JPEG file after all, reportlab converts it
+                        xobject = pdfdoc.PDFImageXObject(name, info.path)
+                except (OSError, SyntaxError) as e:
+                    # PIL raises OSError (or SyntaxError, for some broken headers) if the file is not a valid image
+                    xobject = self.original_jpeg_xobject(info, name, e)
+            self.xobjects[key] = xobject
+        return self.xobjects[key]
+
+    def original_jpeg_xobject(self, info, name, error):
+        # The XObject of the JPEG file as it is, for an image that could not be prepared. None if there's none.
+        from reportlab.pdfbase import pdfdoc
+
+        if is_jpeg(info.path):
+            xobject = pdfdoc.PDFImageXObject(name)
+            try:
+                with open(info.path, 'rb') as f:
+                    if load_jpeg_xobject(xobject, f.read()):
+                        self.messages.append("Warning: Cannot resample \"{}\" ({}), embedding it as it is.".format(
+                            info.filename, error))
+                        return xobject
+            except OSError:
+                pass
+        self.messages.append("Error: Cannot read \"{}\" ({}), skipping it.".format(info.filename, error))
+        return None
+
+    def take_messages(self):
+        # The messages added since the last call, images are prepared by other threads
+        messages = []
+        while len(self.messages) > 0:
+            messages.append(self.messages.popleft())
+        return messages
+
+    def resample(self, info, size, quality):
+        # Transcoded photos are quicker to resample than their originals (i.e. TIFF files), see resample_image()
+        path = info.path
+        if not is_jpeg(path) and self.transcoded_path(info, '.jpg') is not None:
+            path = self.transcoded_path(info, '.jpg')
+        with self.timings.timed('resample', info.filename):
+            return resample_image(path, size, quality)
+
+    def transcoded_path(self, info, extension):
+        # The cache file of the transcoded image, None if there's none
+        if self.transcoded_folder is None:
+            return None
+        path = join(self.transcoded_folder, info.hash + extension)
+        return path if isfile(path) else None
+
+    def transcoded(self, info):
+        # The data of transcode_image() and its extension. Files are named after the content hash of the original, so
+        # each image is transcoded once for all the documents and runs.
+        for extension in ('.jpg', '.flate'):
+            path = self.transcoded_path(info, extension)
+            if path is not None:
+                try:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                    os.utime(path)
+                    return data, extension
+                except OSError:
+                    pass
+        with self.timings.timed('transcode', info.filename):
+            data, extension = transcode_image(info.path)
+        if self.transcoded_folder is not None:
+            write_cache_file(join(self.transcoded_folder, info.hash + extension), data)
+        return data, extension
+
+    def transcode(self, infos, workers=PREPARE_WORKERS):
+        # Transcodes in parallel the images that are not JPEG files and are not in the cache yet. Without a cache they
+        # are transcoded when drawn. It returns the images that cannot be read, as (info, error).
+        infos = [info for info in infos if not is_jpeg(info.path) and self.transcoded_path(info, '.jpg') is None and
+                 self.transcoded_path(info, '.flate') is None]
+        if self.transcoded_folder is None or len(infos) == 0:
+            return []
+        with ThreadPoolExecutor(workers) as executor:
+            errors = executor.map(self.transcode_error, infos)
+            return [(info, error) for info, error in zip(infos, errors) if error is not None]
+
+    def transcode_error(self, info):
+        # Transcodes an image, it returns the error if it cannot be read
+        try:
+            self.transcoded(info)
+        except (OSError, SyntaxError) as e:
+            # PIL raises OSError (or SyntaxError, for some broken headers) if the file is not a valid image
+            return e
+        return None
+
+    def release(self):
+        # Forget the prepared XObjects, the documents that use them keep their own references
+        self.xobjects = {}
+
+    def prepared(self, requests, workers=PREPARE_WORKERS, window=PREPARE_WINDOW):
+        # Generator of the XObjects of requests, (info, size, quality, persistent) tuples, in the same order. A pool of
+        # threads prepares them ahead of the caller (Pillow releases the GIL while decoding, resizing and encoding), at
+        # most window at a time so that only a bounded number of images are in flight.
+        requests = iter(requests)
+        with ThreadPoolExecutor(workers) as executor:
+            pending = deque(executor.submit(self.xobject, *request) for request in itertools.islice(requests, window))
+            while len(pending) > 0:
+                xobject = pending.popleft().result()
+                for request in itertools.islice(requests, 1):
+                    pending.append(executor.submit(self.xobject, *request))
+                yield xobject
+
+    def cached_resample(self, info, size, quality):
+        # Files are named after the content hash of the original, so renaming an image doesn't invalidate them. The
+        # extension tells photos from graphics, see resample_image().
+        path = join(self.cache_folder, '{}_{}x{}_q{}'.format(info.hash, size[0], size[1], quality))
+        for extension in ('.jpg', '.flate'):
+            try:
+                with open(path + extension, 'rb') as f:
+                    data = f.read()
+                # The modification time marks the most recently used files, see trim_cache()
+                os.utime(path + extension)
+                return data, extension
+            except OSError:
+                pass
+
+        data, extension = self.resample(info, size, quality)
+        write_cache_file(path + extension, data)
+        return data, extension
+
+    def trim_cache(self):
+        if self.cache_folder is not None:
+            trim_folder(self.cache_folder, self.max_cache_bytes)
+        if self.transcoded_folder is not None:
+            trim_folder(self.transcoded_folder, self.max_transcoded_bytes)
+
+
 class FotoPDF:
 
-    def __init__(self, input_folder, header_widget=None, detail_widget=None):
+    def __init__(self, input_folder, header_widget=None, detail_widget=None, use_cache=True, only_languages=None,
+                 stream_pages=0, incremental=False, profile=False):
         self.header_widget = header_widget
         self.detail_widget = detail_widget
-
-        # If used as command line (GUI = False), the input folder is sys.argv[1]
+        self.use_cache = use_cache
+        # If given, only the setting files of these languages are used
+        self.only_languages = only_languages
+        # If > 0, every stream_pages pages the document is written to disk, see end_page()
+        self.stream_pages = stream_pages
+        # Only the pages whose inputs changed are drawn again, see page_plan()
+        self.incremental = incremental
+        # Cached pages of the documents built, never removed by trim_caches()
+        self.used_pages = set()
+        # A cProfile and tracemalloc report is written next to each PDF, see build_document()
+        self.profile = profile
+        self.profiled_timings = None
+        # If given, a process pool compressing the documents in the background, see resave_pdf()
+        self.compressor = None
+        self.compressions = []
+
+        # If used as command line, the input folder is the first element of a list
         if self.header_widget is None:
             self.input_folder = str(input_folder[0])
         else:
@@ -131,8 +1342,31 @@ class FotoPDF:
         # if USE_FPDF:
         #     self.pdf = None
         self.c = None
+        self.parts = []
+        self.pending_parts = deque()
         self.images = []
+        self.index = {}
+        self.captions = {}
+        self.subset_characters = ""
+        self.unreadable_images = []
+        # Durations of the stages of the build, Timings.on_timing receives them as they happen
+        self.timings = Timings()
+        self.store = ImageStore(join(self.input_folder, CACHE_FOLDER, 'thumbnails') if use_cache else None,
+                                timings=self.timings,
+                                transcoded_folder=join(self.input_folder, CACHE_FOLDER, 'transcoded') if use_cache
+                                else None)
+        self.slide_xobjects = {}
+        self.image_areas = {}
         self.language = None
+        # If given, it's called with a Progress after each page, from the thread building the document
+        self.progress = None
+        self.cancel_requested = False
+        self.pages_done = 0
+        self.pages_total = 0
+        self.current_image = None
+        self.bytes_written = 0
+        # Image data added to the canvas and not saved yet, most of what the canvas will write
+        self.bytes_drawn = 0
 
     def message_on_header_widget(self, text):
         if self.header_widget is None:
@@ -149,7 +1383,8 @@ class FotoPDF:
             else:
                 self.detail_widget.setText(text)
 
-    def whichcaption(self, text):
+    @staticmethod
+    def whichcaption(text, language):
         if len(text) > 0:
             captions = text.split("#")
             captions = list(filter(None, captions))
@@ -160,13 +1395,13 @@ class FotoPDF:
             # They are used, look for the right language
             else:
                 caption = ""
-                if self.language is None:
+                if language is None:
                     caption = captions[0][3:]
                 else:
                     for candidate in captions:
                         # Ignore strings that are too short, probably formatting errors
                         if len(candidate) > 4:
-                            if candidate[:2].lower() == self.language:
+                            if candidate[:2].lower() == language:
                                 caption = candidate[3:]
 
             return caption
@@ -241,63 +1476,134 @@ class FotoPDF:
         self.c.drawString((self.W - text_width) / 2.0, self.top2bottom(from_top, size), text)
 
     def rl_text(self, text, font, alignment, size, interline, from_side, from_top, black=True):
-        stylesheet = getSampleStyleSheet()
-        style = stylesheet['BodyText']
-        style.fontSize = size
-        style.fontName = font
-        # 0 = left
-        # 1 = center
-        # 2 = right
-        # 4 = justify
-        style.alignment = alignment
-        if black:
-            style.textColor = colors.black
-        else:
-            style.textColor = colors.white
-        style.leading = size + interline
+        self.draw_text(self.layout_text(text, font, alignment, size, interline, from_side, from_top, black=black),
+                       from_side, from_top)
+
+    def layout_text(self, text, font, alignment, size, interline, from_side, from_top, black=True):
+        # The text laid out for the area below from_top, see fit_paragraph()
+        from reportlab.pdfbase import pdfmetrics
 
-        p = Paragraph(text, style)
         text_area_w = self.W - (from_side * 2)
         text_area_h = self.H - from_top
-        text_w, text_h = p.wrap(text_area_w, text_area_h)
-        if text_w <= text_area_w and text_h <= text_area_h:
-            # If there's enough space, draw
-            # drawOn requires the bottom left corner of the text to draw, converting the y coordinate
-            p.drawOn(self.c,
-                     from_side,
-                     self.top2bottom(from_top, text_h) if (from_top > 0) else self.top2bottom((self.H - text_h) / 2.,
-                                                                                              text_h))
-        else:
-            # Otherwise report a warning and suggest make more space for text or use a smaller font
+        with self.timings.timed('wrap'):
+            layout = fit_paragraph(text, pdfmetrics.getFont(font), size, interline, bool(black), alignment,
+                                   text_area_w, text_area_h)
+        if layout is None:
+            # Report a warning and suggest make more space for text or use a smaller font
             self.message_on_detail_widget(
                 "Warning: text area too small for text. Try making the area larger or reducing the font size.")
+        elif layout[2] != size:
+            self.message_on_detail_widget(
+                "Warning: font size of \"{}\" reduced from {} to {:g} to fit the text area.".format(
+                    text if len(text) <= 40 else text[:40] + "...", size, layout[2]))
+        return layout
+
+    def draw_text(self, layout, from_side, from_top):
+        # Nothing is drawn if the text doesn't fit (layout is None)
+        if layout is not None:
+            paragraph, text_h, _ = layout
+            # drawOn requires the bottom left corner of the text to draw, converting the y coordinate
+            paragraph.drawOn(self.c,
+                             from_side,
+                             self.top2bottom(from_top, text_h) if (from_top > 0) else self.top2bottom(
+                                 (self.H - text_h) / 2., text_h))
 
-    def rl_centered_image(self, image, from_side, from_top, from_bottom):
-        # Read ImageDescription field from JPG. Exifread is the only library that works. Exif doesn't have this tag and
-        # Pillow corrupts the accented characters.
-        tags = exifread.process_file(open(image, 'rb'))
-        try:
-            caption = self.whichcaption(str(tags['Image ImageDescription']))
-        except:
-            caption = ""
-            self.message_on_detail_widget("Warning: \"{}\" does not have a caption.".format(os.path.basename(image)))
+    def cover_rect(self, info):
+        zoom = float(self.obj['cover']['zoom'])
+        return self.fit_image(-self.W / 2.0 * (zoom - 1.0), -self.H / 2.0 * (zoom - 1.0), self.W * zoom,
+                              self.H * zoom, info.width, info.height)
+
+    def slide_rect(self, info):
+        from_side = int(self.obj['photos']['from_side'])
+        from_top = int(self.obj['photos']['from_top'])
+        from_bottom = int(self.obj['photos']['from_bottom'])
+        return self.fit_image(from_side, from_top, self.W - from_side * 2, self.H - from_top - from_bottom, info.width,
+                              info.height, valign=0)
+
+    def plan_image_areas(self):
+        # The largest area (width, height in points) each image is drawn at, on the cover and on its slide. Both are
+        # resampled for that area, so the cover image is embedded once and not twice at slightly different sizes.
+        self.image_areas = {}
+        drawn = [(self.index[image], self.slide_rect(self.index[image])) for image in self.images]
+        if bool(self.obj['cover']['show']):
+            cover = self.index[self.images[self.obj["cover"]["use_image"] - 1]]
+            drawn.append((cover, self.cover_rect(cover)))
+        for info, (_, _, width, height) in drawn:
+            self.image_areas[info.hash] = max((width, height), self.image_areas.get(info.hash, (0, 0)))
+
+    def image_target_size(self, info, width, height, persistent=False):
+        # Size in pixel needed to draw the image on a width x height points area at the resolution set in the
+        # settings, or None if the original file is good enough (or resampling is disabled with dpi = 0). Thumbnails
+        # (persistent) are always resampled, at the default resolution if it's disabled.
+        if not persistent:
+            width, height = max((width, height), self.image_areas.get(info.hash, (0, 0)))
+        dpi = float(self.obj['images']['dpi'])
+        if dpi <= 0 and persistent:
+            dpi = float(DEFAULT_SETTINGS['images']['dpi'])
+        if dpi <= 0:
+            return None
+        target_w = int(math.ceil(width * dpi / 72.))
+        target_h = int(math.ceil(height * dpi / 72.))
+        if target_w >= info.width or target_h >= info.height:
+            return None
+        return target_w, target_h
+
+    def image_request(self, info, width, height, persistent=False):
+        # What the image store needs to prepare the image for a width x height points area
+        size = self.image_target_size(info, width, height, persistent)
+        if size is None:
+            return info, None, None, False
+        return info, size, int(self.obj['images']['jpeg_quality']), persistent
+
+    def image_xobject(self, info, width, height, persistent=False):
+        # The XObject of the image resampled for a width x height points area
+        return self.store.xobject(*self.image_request(info, width, height, persistent))
+
+    def rl_draw_image(self, info, x, y, width, height, xobject=None):
+        # Same as drawImage, but the XObject comes from the image store so the file is not read again for every
+        # document. Each document registers its own copy of the XObject, the stream data is shared.
+        if xobject is None:
+            xobject = self.image_xobject(info, width, height)
+        for message in self.store.take_messages():
+            self.message_on_detail_widget(message)
+        if xobject is None:
+            # The image cannot be read, the rest of the page is drawn anyway
+            return None
+        with self.timings.timed('draw_image', info.filename):
+            reg_name = self.c._doc.getXObjectName(xobject.name)
+            if reg_name not in self.c._doc.idToObject:
+                self.c._doc.addForm(xobject.name, copy.copy(xobject))
+                self.bytes_drawn += len(xobject.streamContent)
+
+            self.c._currentPageHasImages = 1
+            self.c.saveState()
+            self.c.translate(x, y)
+            self.c.scale(width, height)
+            self.c._code.append("/{} Do".format(reg_name))
+            self.c.restoreState()
+            self.c._formsinuse.append(xobject.name)
+        return xobject
+
+    def rl_centered_image(self, info, from_side, from_top, from_bottom, xobject=None):
+        # Caption and size come from the image index, the file is not read again here
+        caption = self.captions[self.language][info.filename]
 
-        original_image_size = PIL.Image.open(image).size
         scaled_image_x, scaled_image_y, scaled_image_w, scaled_image_h = self.fit_image(from_side,
                                                                                         from_top,
                                                                                         self.W - from_side * 2,
                                                                                         self.H - from_top - from_bottom,
-                                                                                        original_image_size[0],
-                                                                                        original_image_size[1],
+                                                                                        info.width,
+                                                                                        info.height,
                                                                                         valign=0)
 
-        # drawImage requires the bottom left corner of the image to draw, converting the y coordinate
-        self.c.drawImage(image,
-                         x=scaled_image_x,
-                         y=self.top2bottom(scaled_image_y, scaled_image_h),
-                         width=scaled_image_w,
-                         height=scaled_image_h,
-                         mask=None)
+        # drawImage requires the bottom left corner of the image to draw, converting the y coordinate. The XObject is
+        # kept as the grid might reuse it.
+        self.slide_xobjects[info.filename] = self.rl_draw_image(info,
+                                                                x=scaled_image_x,
+                                                                y=self.top2bottom(scaled_image_y, scaled_image_h),
+                                                                width=scaled_image_w,
+                                                                height=scaled_image_h,
+                                                                xobject=xobject)
 
         self.message_on_detail_widget("Image rescaled to: {} x {}".format(scaled_image_w, scaled_image_h))
 
@@ -305,7 +1611,24 @@ class FotoPDF:
 
         return bottom_of_the_image, caption
 
+    @staticmethod
+    def setting_file_language(setting_file, setting_file_suffix):
+        if len(setting_file_suffix) > 0:
+            if setting_file_suffix.lower() in LANGUAGES:
+                return setting_file_suffix.lower()
+        else:
+            # If the setting file has no suffix (so, we have only one setting file), but that ends with something that
+            # looks like a language, then process it as such. -5 is to remove .json.
+            if setting_file[-7:-5].lower() in LANGUAGES:
+                return setting_file[-7:-5].lower()
+        return None
+
     def inizialize_pdf(self, setting_file, setting_file_suffix):
+        from reportlab.lib.pagesizes import A4, landscape
+        import reportlab.rl_config
+
+        reportlab.rl_config.warnOnMissingFontGlyphs = 0
+
         # In any case, write to drag folder here
         self.message_on_header_widget("Drag folder here")
         self.message_on_detail_widget("Using setting file \"{}\".".format(setting_file), append=True)
@@ -313,7 +1636,12 @@ class FotoPDF:
         # Lettura JSON
         with open(join(self.input_folder, setting_file), 'r', encoding="utf8") as myjson:
             data = myjson.read()
-        self.obj = json.loads(data)
+        try:
+            self.obj = json.loads(data)
+        except ValueError as e:
+            self.message_on_detail_widget("Error: \"{}\" is not a valid JSON file ({}).".format(setting_file, e))
+            return False
+        merge_defaults(self.obj, DEFAULT_SETTINGS)
 
         # Creazione file e impostazioni generali
         if self.obj["document"]["format"] == "A4":
@@ -325,6 +1653,17 @@ class FotoPDF:
             self.message_on_detail_widget("Error: Wrong slide format.")
             return False
 
+        # Other values would be taken for one of these further on, without a word
+        if self.obj['grid']['layout'] not in GRID_LAYOUTS:
+            self.message_on_detail_widget("Warning: grid.layout must be one of {}, using fixed.".format(
+                ", ".join(GRID_LAYOUTS)))
+            self.obj['grid']['layout'] = 'fixed'
+        # Checked before drawing anything, they are used only once the document is saved
+        for key, values in (('compression', COMPRESSIONS), ('quality', QUALITY_PRESETS), ('color', COLOR_FIXES)):
+            if self.obj['output'][key] not in values:
+                self.message_on_detail_widget("Error: output.{} must be one of {}.".format(key, ", ".join(values)))
+                return False
+
         output_filename = clean_html(self.obj['document']['title']) + ', ' + clean_html(self.obj['document']['author'])
         if len(self.obj['document']['suffix']) > 0:
             output_filename = output_filename + ', ' + clean_html(self.obj['document']['suffix'])
@@ -332,23 +1671,17 @@ class FotoPDF:
         # If the setting file has a suffix (to have it, we must have at least 2 setting files)
         if len(setting_file_suffix) > 0:
             output_filename = output_filename + ' ' + setting_file_suffix
-            if setting_file_suffix.lower() in LANGUAGES:
-                self.language = setting_file_suffix.lower()
-                self.message_on_detail_widget(
-                    "Suffix \"{}\" looks like a language tag. I'll use captions starting with \"#{}\" if present.".format(
-                        self.language, self.language))
-        else:
-            # If the setting file has no suffix (so, we have only one setting file), but that ends with something that
-            # looks like a language, then process it as such. -5 is to remove .json.
-            if setting_file[-7:-5] in LANGUAGES:
-                self.language = setting_file[-7:-5].lower()
-                self.message_on_detail_widget(
-                    "Suffix \"{}\" looks like a language tag. I'll use captions starting with \"#{}\" if present.".format(
-                        self.language, self.language))
+        self.language = self.setting_file_language(setting_file, setting_file_suffix)
+        if self.language is not None:
+            self.message_on_detail_widget(
+                "Suffix \"{}\" looks like a language tag. I'll use captions starting with \"#{}\" if present.".format(
+                    self.language, self.language))
 
         output_filename = output_filename + ".pdf"
 
-        self.abs_tmp_output_filename = join(self.input_folder, 'tmp.pdf')
+        # The temporary file is named after the output, so that documents can be built concurrently
+        self.abs_tmp_output_filename = join(self.input_folder, 'tmp ' + output_filename)
+        self.slide_xobjects = {}
         self.abs_output_filename = join(self.input_folder, output_filename)
 
         # if USE_FPDF:
@@ -367,46 +1700,122 @@ class FotoPDF:
         #     self.pdf.add_font('font_author', '', self.obj["fonts"]["author"], uni=True)
         #     self.pdf.add_font('font_text', '', self.obj["fonts"]["text"], uni=True)
 
-        # Constructor
-        self.c = canvas.Canvas(self.abs_tmp_output_filename, enforceColorSpace='RGB')
-        self.c.setPageSize((self.W, self.H))
-        self.c.setTitle(self.obj["document"]["title"])
-        self.c.setAuthor(self.obj["document"]["author"])
-
         # Use user-defined True Type Font (TTF)
         try:
-            pdfmetrics.registerFont(TTFont('font_title', resource_path(self.obj["fonts"]["title"])))
+            load_font('font_title', resource_path(self.obj["fonts"]["title"]))
         except:
             self.message_on_detail_widget(
                 "Error: Cannot find font_title, looking in {}".format(resource_path(self.obj["fonts"]["title"])))
             return False
 
         try:
-            pdfmetrics.registerFont(TTFont('font_author', resource_path(self.obj["fonts"]["author"])))
+            load_font('font_author', resource_path(self.obj["fonts"]["author"]))
         except:
             self.message_on_detail_widget("Error: Cannot find font_author, looking in {}".format(
                 resource_path(self.obj["fonts"]["author"])))
             return False
 
         try:
-            pdfmetrics.registerFont(TTFont('font_text', resource_path(self.obj["fonts"]["text"])))
+            load_font('font_text', resource_path(self.obj["fonts"]["text"]))
         except:
             self.message_on_detail_widget("Error: Cannot find font_text, looking in {}".format(
                 resource_path(self.obj["fonts"]["author"])))
             return False
 
-        self.c.setFont('font_text', 16)
+        # Constructor. In incremental mode, canvases are created by build_document() once it knows which pages must be
+        # drawn.
+        self.parts = []
+        self.pending_parts = deque()
+        if not self.incremental:
+            self.new_canvas()
 
-        # Ricerca immagini
-        self.images = [f for f in listdir(self.input_folder) if f.lower().endswith(".jpg")]
-        self.images.sort(key=natural_keys)
+        # Images have already been indexed by create_pdf, once for all the setting files
         if len(self.images) == 0:
             self.message_on_detail_widget("Error: No image found in folder.", append=True)
             return False
-        self.message_on_detail_widget("Creating PDF...")
 
         return True
 
+    def new_canvas(self):
+        from reportlab.pdfgen import canvas
+
+        # In streaming mode each canvas becomes a part of the document, merged by save_pdf(). In incremental mode each
+        # page is a part, saved under a temporary name and renamed when complete.
+        if self.incremental:
+            filename = '{}.{}.tmp'.format(self.pending_parts[0], os.getpid())
+        elif self.stream_pages > 0:
+            self.parts.append('{}.part{}'.format(self.abs_tmp_output_filename, len(self.parts)))
+            filename = self.parts[-1]
+        else:
+            filename = self.abs_tmp_output_filename
+        self.c = canvas.Canvas(filename, enforceColorSpace='RGB')
+        self.c.setPageSize((self.W, self.H))
+        self.c.setTitle(self.obj["document"]["title"])
+        self.c.setAuthor(self.obj["document"]["author"])
+        self.c.setFont('font_text', 16)
+
+        # Characters are added to the font subsets as they are drawn, so each document (and, in streaming and
+        # incremental mode, each part) embeds different subsets. A shared subset starts with the same characters, those
+        # of all the captions and Latin-1, in any document: the font files are the same and are merged in one.
+        if self.obj['fonts']['shared_subset']:
+            from reportlab.pdfbase import pdfmetrics
+            for font in FONTS:
+                pdfmetrics.getFont('font_' + font).splitString(self.subset_characters, self.c._doc)
+
+    def end_page(self):
+        self.c.showPage()
+        if self.incremental:
+            self.c.save()
+            part = self.pending_parts.popleft()
+            os.replace(self.c._filename, part)
+            self.bytes_written += getsize(part)
+            self.bytes_drawn = 0
+            self.c = None
+            if len(self.pending_parts) > 0:
+                self.new_canvas()
+        # reportlab keeps the whole document in memory until it's saved. In streaming mode, every stream_pages pages
+        # the canvas is saved as a part and a new one is started, so that memory doesn't grow with the number of
+        # images. The price is that each part embeds its own copy of fonts and of images used in more than one part.
+        elif self.stream_pages > 0 and self.c.getPageNumber() > self.stream_pages:
+            self.c.save()
+            self.bytes_written += getsize(self.c._filename)
+            self.bytes_drawn = 0
+            self.c = None
+            self.store.release()
+            self.slide_xobjects = {}
+            # reportlab documents are full of reference cycles and the garbage collector doesn't run by itself often
+            # enough, since it counts objects and not bytes
+            gc.collect()
+            self.new_canvas()
+
+        self.pages_done += 1
+        self.report_progress()
+        if self.cancel_requested:
+            raise BuildCancelled()
+
+    def report_progress(self):
+        if self.progress is not None:
+            self.progress(Progress(basename(self.abs_output_filename), self.pages_done, self.pages_total,
+                                   self.current_image, self.bytes_written + self.bytes_drawn))
+
+    def cancel(self):
+        # Can be called from any thread: the build stops at the end of the current page and the documents not started
+        # yet are skipped
+        self.cancel_requested = True
+
+    def discard_document(self):
+        # Removes what a cancelled build has written, but the pages of the incremental mode that are complete
+        self.c = None
+        self.bytes_drawn = 0
+        self.store.release()
+        self.slide_xobjects = {}
+        if not self.incremental:
+            for part in self.parts:
+                if isfile(part):
+                    os.remove(part)
+        self.parts = []
+        self.pending_parts = deque()
+
     def cover_page(self):
         # if USE_FPDF:
         #     self.pdf.add_page()
@@ -425,20 +1834,13 @@ class FotoPDF:
         #                             self.obj["cover"]["author"]["black_text"])
 
         # Draw the image horizontally center and scaled to occupy the whole frame. It expects an horizontal image.
-        original_image_size = PIL.Image.open(
-            join(self.input_folder, self.images[self.obj["cover"]["use_image"] - 1])).size
-        zoom = float(self.obj['cover']['zoom'])
-        scaled_image_x, scaled_image_y, scaled_image_w, scaled_image_h = self.fit_image(-self.W/2.0*(zoom-1.0),
-                                                                                        -self.H/2.0*(zoom-1.0),
-                                                                                        self.W*zoom, self.H*zoom,
-                                                                                        original_image_size[0],
-                                                                                        original_image_size[1])
-        self.c.drawImage(join(self.input_folder, self.images[self.obj["cover"]["use_image"] - 1]),
-                         x=scaled_image_x,
-                         y=scaled_image_y,
-                         width=scaled_image_w,
-                         height=scaled_image_h,
-                         preserveAspectRatio=True)
+        info = self.index[self.images[self.obj["cover"]["use_image"] - 1]]
+        scaled_image_x, scaled_image_y, scaled_image_w, scaled_image_h = self.cover_rect(info)
+        self.rl_draw_image(info,
+                           x=scaled_image_x,
+                           y=scaled_image_y,
+                           width=scaled_image_w,
+                           height=scaled_image_h)
 
         # Draw the title horizontally centered
         self.rl_text(self.obj['document']['title'],
@@ -456,7 +1858,7 @@ class FotoPDF:
                                           int(self.obj['cover']['author']['size']),
                                           self.vrel2abs(float(self.obj['cover']['author']['from_top'])),
                                           self.obj["cover"]["author"]["black_text"])
-        self.c.showPage()
+        self.end_page()
 
     def description_page(self):
         # if USE_FPDF:
@@ -477,9 +1879,13 @@ class FotoPDF:
                      int(self.obj['description']['interline']),
                      self.vrel2abs(float(self.obj['description']['from_side'])),
                      self.vrel2abs(float(self.obj['description']['from_top'])))
-        self.c.showPage()
+        self.end_page()
+
+    def image_pages(self, images=None):
+        # Draws the pages of the given images, all of them by default
+        if images is None:
+            images = self.images
 
-    def image_pages(self):
         # if USE_FPDF:
         #     self.pdf.set_font_size(int(self.obj['photos']['size']))
         #     for i, image in enumerate(self.images):
@@ -502,40 +1908,56 @@ class FotoPDF:
         #                             txt=str(self.obj['photos']['captions'][i]['caption']), border=0, align="L",
         #                             fill=False)
 
-        for i, image in enumerate(self.images):
-            text_x, caption = self.rl_centered_image(join(self.input_folder, image),
-                                                     int(self.obj['photos']['from_side']),
-                                                     int(self.obj['photos']['from_top']),
-                                                     int(self.obj['photos']['from_bottom']))
-            self.rl_text(caption,
-                         'font_text',
-                         0,
-                         int(self.obj['photos']['size']),
-                         int(self.obj['photos']['interline']),
-                         int(self.obj['photos']['from_side']),
-                         (text_x + 1. * int(self.obj['photos']['size']) + 0. * int(self.obj['photos']['interline'])))
-            self.c.showPage()
-
-    def grid_page(self):
-        r = int(self.obj['grid']['rows'])
-        c = int(self.obj['grid']['columns'])
-        m_oriz = int(self.obj["grid"]["horizontal_margin"])
-        m_vert = int(self.obj["grid"]["vertical_margin"])
-        m_lat = int(self.obj["grid"]["lateral_margin"])
-        fitting_block_ratio = float(self.obj["grid"]["fitting_block_ratio"])
-
-        # Starting from columns and checking if the total height is within the margins
-        rect_w = (self.W - 2 * m_lat - (c - 1) * m_oriz) / c
-        rect_h = rect_w / fitting_block_ratio
-        total_h = r * rect_h + (r - 1) * m_vert + m_lat
-        # Too high, restarting from rows and checking if the total width is within the margins
-        if total_h > self.H:
-            rect_h = (self.H - 2 * m_lat - (r - 1) * m_vert) / r
-            rect_w = rect_h * fitting_block_ratio
-            total_w = c * rect_w + (c - 1) * m_oriz + m_lat
-            if total_w > self.W:
-                print("It cannot be.")
-
+        from_side = int(self.obj['photos']['from_side'])
+        from_top = int(self.obj['photos']['from_top'])
+        from_bottom = int(self.obj['photos']['from_bottom'])
+
+        # Images are prepared in parallel, a few pages ahead of the one being drawn
+        requests = []
+        for image in images:
+            info = self.index[image]
+            _, _, scaled_image_w, scaled_image_h = self.slide_rect(info)
+            requests.append(self.image_request(info, scaled_image_w, scaled_image_h))
+
+        # Captions are laid out before drawing, a caption is wrapped again only if its text or its settings change
+        size = int(self.obj['photos']['size'])
+        captions = []
+        for image in images:
+            _, scaled_image_y, _, scaled_image_h = self.slide_rect(self.index[image])
+            text_y = scaled_image_y + scaled_image_h + 1. * size + 0. * int(self.obj['photos']['interline'])
+            captions.append((text_y, self.layout_text(self.captions[self.language][image],
+                                                      'font_text',
+                                                      0,
+                                                      size,
+                                                      int(self.obj['photos']['interline']),
+                                                      from_side,
+                                                      text_y)))
+
+        for image, xobject, (text_y, caption) in zip(images, self.store.prepared(requests), captions):
+            self.current_image = image
+            self.rl_centered_image(self.index[image],
+                                   from_side,
+                                   from_top,
+                                   from_bottom,
+                                   xobject=xobject)
+            self.draw_text(caption, from_side, text_y)
+            self.end_page()
+
+    def plan_grid(self):
+        # The images of each grid page and their rectangles, see grid_layout()
+        grid = self.obj['grid']
+        infos = [self.index[image] for image in self.images]
+        pages = grid_layout([info.width / info.height for info in infos], self.W, self.H,
+                            grid['layout'],
+                            int(grid['rows']),
+                            int(grid['columns']),
+                            int(grid["horizontal_margin"]),
+                            int(grid["vertical_margin"]),
+                            int(grid["lateral_margin"]),
+                            float(grid["fitting_block_ratio"]))
+        self.grid_pages = [[(infos[int(i)], (x, y, w, h)) for i, x, y, w, h in page.tolist()] for page in pages]
+
+    def grid_page(self, cells):
         # if USE_FPDF:
         #     self.pdf.add_page()
         #     if bool(self.obj['grid']['black_background']):
@@ -551,27 +1973,28 @@ class FotoPDF:
             self.c.setFillColorRGB(0, 0, 0)
             self.c.rect(0, 0, self.W, self.H, fill=1)
 
-        for i, image in enumerate(self.images):
-            original_image_size = PIL.Image.open(join(self.input_folder, image)).size
-            rect_x = (self.W - (c * rect_w + (c - 1) * m_oriz)) / 2 + (i % c) * (rect_w + m_oriz)
-            rect_y = self.H - rect_h - ((self.H - (r * rect_h + (r - 1) * m_vert)) / 2 + int(i / c) * (rect_h + m_vert))
-            scaled_image_x, scaled_image_y, scaled_image_w, scaled_image_h = self.fit_image(rect_x, rect_y,
-                                                                                            rect_w, rect_h,
-                                                                                            original_image_size[0],
-                                                                                            original_image_size[1])
-            self.c.drawImage(join(self.input_folder, image),
-                             x=scaled_image_x,
-                             y=scaled_image_y,
-                             width=scaled_image_w,
-                             height=scaled_image_h,
-                             mask=None)
+        if bool(self.obj['grid']['thumbnails']):
+            # Thumbnails sized for the cells, prepared in parallel and kept in the cache folder to be generated once
+            xobjects = self.store.prepared(self.image_request(info, scaled_image_w, scaled_image_h, persistent=True)
+                                           for info, (_, _, scaled_image_w, scaled_image_h) in cells)
+        else:
+            # The same XObjects of the full-page slides, so no further image data is added to the PDF
+            xobjects = (self.slide_xobjects.get(info.filename) for info, _ in cells)
+
+        for (info, (scaled_image_x, scaled_image_y, scaled_image_w, scaled_image_h)), xobject in zip(cells, xobjects):
+            self.rl_draw_image(info,
+                               x=scaled_image_x,
+                               y=scaled_image_y,
+                               width=scaled_image_w,
+                               height=scaled_image_h,
+                               xobject=xobject)
             # self.c.drawImage(join(self.input_folder, image),
             #                  x=(self.W - (c * w + (c - 1) * m_oriz)) / 2 + (i % c) * (w + m_oriz),
             #                  y=self.H - h - ((self.H - (r * h + (r - 1) * m_vert)) / 2 + int(i / c) * (h + m_vert)),
             #                  width=w,
             #                  height=h,
             #                  mask=None)
-        self.c.showPage()
+        self.end_page()
 
     def final_page(self):
         # if USE_FPDF:
@@ -637,190 +2060,572 @@ class FotoPDF:
                                               self.vrel2abs(float(self.obj['final']['disclaimer']['from_top'])),
                                               True)
 
-        self.c.showPage()
+        self.end_page()
 
     def save_pdf(self):
         # Salva
         # if USE_FPDF:
         #     self.pdf.output(self.abs_tmp_output_filename, "F")
-        self.c.save()
+        if self.incremental:
+            # All pages are already on disk, old or new
+            merge_pdf_parts(self.parts, self.abs_tmp_output_filename)
+            self.parts = []
+        elif self.stream_pages > 0:
+            # The last canvas is empty if the previous part has just been saved
+            if self.c.getPageNumber() > 1:
+                self.c.save()
+            else:
+                self.parts.pop()
+            self.c = None
+            self.store.release()
+            merge_pdf_parts(self.parts, self.abs_tmp_output_filename)
+            for part in self.parts:
+                os.remove(part)
+            self.parts = []
+        else:
+            self.c.save()
 
-    def read_metadata(self):
-        pass
+    def index_images(self):
+        # Ricerca immagini, read once per folder and shared by all the setting files
+        self.images = [f for f in listdir(self.input_folder) if os.path.splitext(f)[1].lower() in INPUT_FORMATS]
+        self.images.sort(key=natural_keys)
+        self.index = {}
 
-    def resave_pdf(self):
-        if 0:
-            quality = {
-                0: '/default',
-                1: '/prepress',
-                2: '/printer',
-                3: '/ebook',
-                4: '/screen'
-            }
-            args = ['gs', '-sDEVICE=pdfwrite',
-                    '-dCompatibilityLevel=1.4',
-                    '-dPDFSETTINGS={}'.format(quality[0]),
-                    '-dNOPAUSE',
-                    '-dQUIET',
-                    '-dBATCH',
-                    '-dColorAccuracy=2',
-                    '-dProcessColorModel=/DeviceRGB',
-                    '-sOutputFile={}'.format(self.abs_output_filename),
-                    self.abs_tmp_output_filename]
-
-            # '-sDefaultRGBProfile=sRGB_v4_ICC_preference.icc',
-            # '-sOutputICCProfile=sRGB_v4_ICC_preference.icc',
-            # '-sImageICCProfile=sRGB_v4_ICC_preference.icc',
-
-            # Using python ghostscript module
-            encoding = locale.getpreferredencoding()
-            args = [a.encode(encoding) for a in args]
-            ghostscript.Ghostscript(*args)
-
-            # Calling ghoscript directly
-            # subprocess.call(args)
-
-            # Remove original file, called tmp.pdf
-            if os.path.exists(self.abs_tmp_output_filename):
-                os.remove(self.abs_tmp_output_filename)
-        else:
-            os.rename(self.abs_tmp_output_filename, self.abs_output_filename)
+        cache = None
+        if self.use_cache:
+            try:
+                cache = MetadataCache(self.input_folder)
+            except (OSError, sqlite3.Error):
+                self.message_on_detail_widget("Warning: Cannot use the metadata cache, reading all images.")
 
-        self.message_on_header_widget("Created ({:.1f}MB)!".format(
-            getsize(self.abs_output_filename) / 1000000.))
-        self.message_on_detail_widget("Created ({:.1f}MB)!\n".format(
-            getsize(self.abs_output_filename) / 1000000.))
+        self.unreadable_images = []
+        try:
+            for image in self.images:
+                try:
+                    if cache is None:
+                        self.index[image] = read_image_info(join(self.input_folder, image), self.timings)
+                    else:
+                        self.index[image] = cache.get(image, self.timings)
+                except (OSError, SyntaxError) as e:
+                    # PIL raises OSError (or SyntaxError, for some broken headers) if the file is not a valid image
+                    self.message_on_detail_widget("Error: Cannot read \"{}\" ({}).".format(image, e))
+                    self.unreadable_images.append(image)
+        finally:
+            if cache is not None:
+                cache.close()
+                self.message_on_detail_widget("Info: {} images read, {} from cache.".format(cache.misses,
+                                                                                            cache.hits))
+        self.images = [image for image in self.images if image in self.index]
+
+    def transcode_images(self):
+        # Images that are not JPEG files are transcoded before the documents are built, in parallel, see ImageStore
+        with self.timings.timed('transcode_images'):
+            errors = self.store.transcode([self.index[image] for image in self.images])
+        # Like the images that cannot be indexed, see index_images()
+        for info, error in errors:
+            self.message_on_detail_widget("Error: Cannot read \"{}\" ({}).".format(info.filename, error))
+            self.unreadable_images.append(info.filename)
+        self.images = [image for image in self.images if image not in self.unreadable_images]
+
+    def prepare_captions(self, languages):
+        # Captions of all the languages are extracted in one go, before any document is created
+        self.captions = {language: {} for language in languages}
+        for image in self.images:
+            description = self.index[image].description
+            if description is None:
+                self.message_on_detail_widget("Warning: \"{}\" does not have a caption.".format(image))
+                description = ""
+            for language in languages:
+                self.captions[language][image] = self.whichcaption(description, language)
+        self.prepare_font_subset()
+
+    def prepare_font_subset(self):
+        # Characters of the shared font subsets, see new_canvas()
+        characters = set(chr(code) for code in itertools.chain(range(32, 127), range(0xa1, 0x100)))
+        for image in self.images:
+            characters.update(self.index[image].description or "")
+        self.subset_characters = "".join(sorted(c for c in characters if c.isprintable()))
 
-    def create_pdf(self):
-        # Manage the case when more than one json exists
+    def resave_pdf(self):
+        # The temporary file becomes the output, compressed if the settings ask for it. With a pool of compressors
+        # (see create_pdf()) the compression runs in the background while the next document is drawn.
+        compression = self.obj['output']['compression']
+        quality = self.obj['output']['quality']
+        if self.obj['output']['color'] != 'none':
+            with self.timings.timed('fix_colors'):
+                try:
+                    fix_colors(self.abs_tmp_output_filename, self.obj['output']['color'])
+                except Exception as e:
+                    # The PDF is still good, with the colours of before
+                    self.message_on_detail_widget("Warning: Cannot fix the colours of \"{}\" ({}: {}).".format(
+                        basename(self.abs_output_filename), type(e).__name__, e))
+        linearize = bool(self.obj['output']['linearize'])
+        if compression == 'none' and not linearize:
+            os.replace(self.abs_tmp_output_filename, self.abs_output_filename)
+            self.message_created(getsize(self.abs_output_filename))
+            return
+        if compression == 'none':
+            self.message_on_detail_widget("Linearizing...")
+        else:
+            self.message_on_detail_widget("Compressing with {} ({}){}...".format(compression, quality,
+                                                                                 ", linearized" if linearize else ""))
+        if self.compressor is not None:
+            self.compressions.append((basename(self.abs_output_filename),
+                                      self.compressor.submit(compress_pdf, compression, quality,
+                                                             self.abs_tmp_output_filename, self.abs_output_filename,
+                                                             linearize)))
+        else:
+            size, compressed_size, error, seconds = compress_pdf(
+                compression, quality, self.abs_tmp_output_filename, self.abs_output_filename, linearize)
+            self.timings.add('compress', seconds)
+            self.message_compressed(basename(self.abs_output_filename), size, compressed_size, error)
+
+    def message_created(self, size):
+        self.message_on_header_widget("Created ({:.1f}MB)!".format(size / 1000000.))
+        self.message_on_detail_widget("Created ({:.1f}MB)!\n".format(size / 1000000.))
+
+    def message_compressed(self, output_filename, size, compressed_size, error):
+        if error is not None:
+            self.message_on_detail_widget("Warning: \"{}\" created, but {}.".format(output_filename, error))
+        else:
+            self.message_on_detail_widget("Info: \"{}\" compressed from {:.1f}MB to {:.1f}MB ({:+.0%}).".format(
+                output_filename, size / 1000000., compressed_size / 1000000., compressed_size / float(size) - 1))
+        self.message_created(compressed_size)
+
+    def finish_compressions(self):
+        # Waits for the documents being compressed in the background. It returns True if all of them were created: when
+        # compression fails the uncompressed PDF is kept, which is only a warning.
+        all_ok = True
+        for output_filename, future in self.compressions:
+            try:
+                size, compressed_size, error, seconds = future.result()
+            except Exception as e:
+                # i.e. the worker process died
+                self.message_on_detail_widget("Error: Cannot create \"{}\" ({}: {}).".format(
+                    output_filename, type(e).__name__, e))
+                all_ok = False
+                continue
+            self.timings.add('compress', seconds)
+            self.message_compressed(output_filename, size, compressed_size, error)
+        self.compressions = []
+        return all_ok
+
+    def prepare_build(self, create_default=True):
+        # Manage the case when more than one json exists. It returns the (setting file, suffix) of the documents to
+        # create, or an empty list if there's nothing to do.
 
         # Ricerca json
         setting_files = [f for f in listdir(self.input_folder) if f.endswith(".json")]
         setting_files.sort(key=natural_keys)
-        prefix = longest_common_prefix(setting_files)
+        prefix = longest_common_prefix(list(setting_files))
 
         self.message_on_detail_widget("Dragged folder \"{}\".\n".format(self.input_folder), append=False)
 
         # If no JSON is found, a default one will be created from a template
         if len(setting_files) == 0:
-            self.message_on_detail_widget(
-                "Warning: Cannot find settings.json in folder. Creating a default one that will need to be customized.")
-            shutil.copyfile('settings.json', join(self.input_folder, 'settings.json'))
+            if create_default:
+                self.message_on_detail_widget(
+                    "Warning: Cannot find settings.json in folder. Creating a default one that will need to be "
+                    "customized.")
+                shutil.copyfile(resource_path('settings.json'), join(self.input_folder, 'settings.json'))
+            else:
+                self.message_on_detail_widget("Error: Cannot find settings.json in folder.")
+            return []
+
+        # Images, captions and image data are prepared once and shared by all the documents
+        with self.timings.timed('index_images'):
+            self.index_images()
+        # A suffix is useful in case of multiple JSON files to distinguish between the multiple documents that
+        # are generated.
+        documents = [(setting_file, setting_file[len(prefix):-len(".json")]) for setting_file in setting_files]
+        if self.only_languages is not None:
+            documents = [(setting_file, setting_file_suffix) for setting_file, setting_file_suffix in documents
+                         if self.setting_file_language(setting_file, setting_file_suffix) in self.only_languages]
+            if len(documents) == 0:
+                self.message_on_detail_widget("Warning: No setting file for language {}.".format(
+                    ", ".join(self.only_languages)))
+        self.prepare_captions(set(self.setting_file_language(setting_file, setting_file_suffix)
+                                  for setting_file, setting_file_suffix in documents))
+        return documents
+
+    def page_plan(self):
+        # The pages of the document as (page, image, fingerprint), where image is the image of a slide or the number of
+        # a grid page, and the fingerprint identifies everything the page depends on: settings, fonts, images and
+        # captions. Two pages with the same fingerprint are identical.
+        common = [VERSION, PAGES_VERSION, self.W, self.H, self.obj['document'], self.obj['images'],
+                  {font: file_signature(resource_path(self.obj['fonts'][font])) for font in FONTS},
+                  self.subset_characters if self.obj['fonts']['shared_subset'] else None]
+        plan = []
+        if bool(self.obj['cover']['show']):
+            cover = self.index[self.images[self.obj["cover"]["use_image"] - 1]]
+            plan.append(('cover', None, fingerprint(common, 'cover', self.obj['cover'], cover.hash,
+                                                    self.image_areas[cover.hash])))
+        if bool(self.obj['description']['show']):
+            plan.append(('description', None, fingerprint(common, 'description', self.obj['description'])))
+        for image in self.images:
+            plan.append(('image', image, fingerprint(common, 'image', self.obj['photos'], self.index[image].hash,
+                                                     self.image_areas[self.index[image].hash],
+                                                     self.captions[self.language][image])))
+        for number, cells in enumerate(self.grid_pages):
+            plan.append(('grid', number, fingerprint(common, 'grid', self.obj['grid'],
+                                                     [(info.hash, rect) for info, rect in cells])))
+        if self.obj['final']['show']:
+            plan.append(('final', None, fingerprint(common, 'final', self.obj['final'])))
+        return plan
+
+    def build_document(self, setting_file, setting_file_suffix):
+        # Create the document. With profile, the build runs under cProfile and tracemalloc and a report is written next
+        # to the PDF.
+        if not self.profile:
+            return self.draw_document(setting_file, setting_file_suffix)
+
+        import cProfile
+        import tracemalloc
+        # The timings of the first report include the reading of the folder
+        since = self.profiled_timings
+        profiler = cProfile.Profile()
+        tracemalloc.start()
+        profiler.enable()
+        try:
+            ok = self.draw_document(setting_file, setting_file_suffix)
+        finally:
+            profiler.disable()
+            allocations = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        if ok:
+            self.write_profile(profiler, allocations, peak, since)
+        self.profiled_timings = self.timings.snapshot()
+        return ok
+
+    def write_profile(self, profiler, allocations, peak, since):
+        # The binary profile can be opened with pstats or snakeviz, the text report sums it up. cProfile only sees the
+        # thread drawing the pages, the images prepared by the pool show up in the timings.
+        import pstats
+
+        base = os.path.splitext(self.abs_output_filename)[0]
+        profiler.dump_stats(base + '.prof')
+        functions = io.StringIO()
+        pstats.Stats(profiler, stream=functions).sort_stats('cumulative').print_stats(30)
+        with open(base + ' profile.txt', 'w', encoding="utf8") as f:
+            f.write("Timings\n\n{}\n\n".format(self.timings.report(since)))
+            f.write("Peak memory allocated by Python: {:.1f}MB, largest allocations:\n\n".format(peak / 1000000.))
+            for statistic in allocations.statistics('lineno')[:20]:
+                f.write("{}\n".format(statistic))
+            f.write("\nFunctions\n{}".format(functions.getvalue()))
+        self.message_on_detail_widget("Info: Profile written to \"{}\".".format(base + ' profile.txt'))
+
+    def draw_document(self, setting_file, setting_file_suffix):
+        with self.timings.timed('inizialize_pdf'):
+            if not self.inizialize_pdf(setting_file, setting_file_suffix):
+                return False
+        self.message_on_detail_widget("Creating PDF...")
+        self.plan_image_areas()
+        self.plan_grid()
+
+        if self.incremental:
+            # Every page is kept in the cache folder, named after its fingerprint. Only the pages that are not there
+            # yet are drawn, then save_pdf() merges old and new ones.
+            pages_folder = join(self.input_folder, CACHE_FOLDER, 'pages')
+            os.makedirs(pages_folder, exist_ok=True)
+            plan = self.page_plan()
+            self.parts = [join(pages_folder, page_fingerprint + '.pdf') for _, _, page_fingerprint in plan]
+            self.used_pages.update(basename(part) for part in self.parts)
+            todo = []
+            for (page, image, _), part in zip(plan, self.parts):
+                if isfile(part):
+                    # The modification time marks the most recently used pages, see trim_folder()
+                    os.utime(part)
+                else:
+                    todo.append((page, image))
+                    self.pending_parts.append(part)
+            self.message_on_detail_widget("Info: {} pages changed, {} unchanged.".format(len(todo),
+                                                                                      len(plan) - len(todo)))
+            if len(todo) > 0:
+                self.new_canvas()
+            pages = set(page for page, _ in todo)
+            images = [image for page, image in todo if page == 'image']
+            grid_pages = [number for page, number in todo if page == 'grid']
         else:
-            # Create one PDF for each JSON file found
-            for setting_file in setting_files:
-                # A suffix is useful in case of multiple JSON files to distinguish between the multiple documents that
-                # are generated.
-                setting_file_suffix = setting_file[len(prefix):-len(".json")]
-                # Create the document
-                if self.inizialize_pdf(setting_file, setting_file_suffix):
-                    if bool(self.obj['cover']['show']):
-                        self.cover_page()
-                    if bool(self.obj['description']['show']):
-                        self.description_page()
-                    self.image_pages()
-                    self.grid_page()
-                    if self.obj['final']['show']:
-                        self.final_page()
-                    self.save_pdf()
-                    # self.read_metadata()
-                    self.resave_pdf()
-            self.message_on_detail_widget("Drag another folder to create a new one.")
-
-
-class FileEdit(QLineEdit):
-    def __init__(self, parent, detail_widget):
-        super(FileEdit, self).__init__(parent)
-        # Si usa solo nel caso del QLineEdit
-        # self.setDragEnabled(True)
-        self.detail_widget = detail_widget
+            pages = set(['cover', 'description', 'image', 'grid', 'final'])
+            images = self.images
+            grid_pages = range(len(self.grid_pages))
+
+        show = {'cover': bool(self.obj['cover']['show']), 'description': bool(self.obj['description']['show']),
+                'final': bool(self.obj['final']['show'])}
+        self.pages_done = 0
+        self.pages_total = len(images) + len(grid_pages) + len([page for page in pages if show.get(page)])
+        self.current_image = None
+        self.bytes_written = 0
+        self.bytes_drawn = 0
+
+        # The order is the same of page_plan()
+        try:
+            if show['cover'] and 'cover' in pages:
+                with self.timings.timed('cover_page'):
+                    self.cover_page()
+            if show['description'] and 'description' in pages:
+                with self.timings.timed('description_page'):
+                    self.description_page()
+            if len(images) > 0:
+                with self.timings.timed('image_pages'):
+                    self.image_pages(images)
+            self.current_image = None
+            for number in grid_pages:
+                with self.timings.timed('grid_page'):
+                    self.grid_page(self.grid_pages[number])
+            if show['final'] and 'final' in pages:
+                with self.timings.timed('final_page'):
+                    self.final_page()
+        except BuildCancelled:
+            self.discard_document()
+            self.message_on_detail_widget("Warning: \"{}\" cancelled.".format(basename(self.abs_output_filename)))
+            return False
+        with self.timings.timed('save_pdf'):
+            self.save_pdf()
+        self.bytes_written = getsize(self.abs_tmp_output_filename)
+        self.bytes_drawn = 0
+        with self.timings.timed('resave_pdf'):
+            self.resave_pdf()
+        self.report_progress()
+        return True
 
-    def dragEnterEvent(self, event):
-        data = event.mimeData()
-        urls = data.urls()
-        if urls and urls[0].scheme() == 'file':
-            event.acceptProposedAction()
-
-    def dragMoveEvent(self, event):
-        data = event.mimeData()
-        urls = data.urls()
-        if urls and urls[0].scheme() == 'file':
-            event.acceptProposedAction()
-
-    def dropEvent(self, event):
-        data = event.mimeData()
-        urls = data.urls()
-        if urls and urls[0].scheme() == 'file':
-            draggedpath = str(urls[0].path())
-            if isfile(draggedpath) or isdir(draggedpath):
-                pdf = FotoPDF(draggedpath, self, self.detail_widget)
-                pdf.create_pdf()
-            else:
-                self.setText("Invalid file or folder.")
-
-
-class Highlighter(QSyntaxHighlighter):
-    def __init__(self, parent):
-        super(Highlighter, self).__init__(parent)
-        self.infoFormat = QTextCharFormat()
-        self.infoFormat.setForeground(Qt.white)
-        self.infoFormat.setBackground(Qt.green)
-        self.warningFormat = QTextCharFormat()
-        self.warningFormat.setForeground(Qt.black)
-        # self.warningFormat.setBackground(Qt.yellow)
-        self.warningFormat.setBackground(QColor(MACOSYELLOW[0], MACOSYELLOW[1], MACOSYELLOW[2]))
-        self.errorFormat = QTextCharFormat()
-        self.errorFormat.setForeground(Qt.white)
-        self.errorFormat.setBackground(QColor(MACOSRED[0], MACOSRED[1], MACOSRED[2]))
-
-    def highlightBlock(self, text):
-        # uncomment this line for Python2
-        # text = unicode(text)
-        if text.startswith('Info'):
-            self.setFormat(0, len(text), self.infoFormat)
-        elif text.startswith('Warning'):
-            self.setFormat(0, len(text), self.warningFormat)
-        elif text.startswith('Error'):
-            self.setFormat(0, len(text), self.errorFormat)
-
-
-def MainGUI():
-    # app = QApplication(sys.argv)
-    app = QApplication([])
-    win = QMainWindow()
-    win.setGeometry(200, 200, 300, 600)
-    win.setFixedSize(300, 600)
-    win.setWindowTitle("FotoPDF" + " " + VERSION)
-    app.setWindowIcon(QIcon(resource_path('FotoPDF.png')))
-
-    detail_widget = QTextEdit(win)
-    detail_widget.setAlignment(Qt.AlignCenter)
-    highlighter = Highlighter(detail_widget.document())
-    detail_widget.setReadOnly(True)
-    detail_widget.setText("Tip: it works with "
-                          "both a folder or any file in that folder.")
-    detail_widget.setGeometry(0, 300, 300, 300)
-    detail_widget.setStyleSheet("background-color: rgb{}; color: rgb(255,255,255);".format(str(MACOSDARK)))
-
-    # Create widget to accept drag&drop
-    header_widget = FileEdit(win, detail_widget)
-    header_widget.setAlignment(Qt.AlignCenter)
-    header_widget.setReadOnly(True)
-    header_widget.setText("Drag folder here")
-    header_widget.setGeometry(0, 0, 300, 300)
-    font = header_widget.font()
-    font.setPointSize(32)
-    header_widget.setFont(font)
-    header_widget.setStyleSheet(
-        "background-color: rgb{}; color: rgb(255,255,255);border : 5px solid rgb{};".format(str(MACOSYELLOW),
-                                                                                            str(MACOSDARK)))
-    win.show()
-    sys.exit(app.exec_())
+    def submit_documents(self, executor, documents):
+        # Each document is built by a worker process, starting from the index and the captions prepared here
+        return [executor.submit(build_document_in_worker, self.input_folder, setting_file, setting_file_suffix,
+                                self.images, self.index, self.captions, self.use_cache, self.stream_pages,
+                                self.incremental, self.profile)
+                for setting_file, setting_file_suffix in documents]
+
+    def collect_documents(self, futures):
+        # Messages of the workers are shown in the same order as the setting files, as if built one after the other.
+        # It returns True if all documents were created.
+        all_ok = True
+        for future in futures:
+            try:
+                ok, messages, used_pages = future.result()
+            except Exception as e:
+                self.message_on_detail_widget("Error: {}".format(e))
+                all_ok = False
+                continue
+            self.used_pages.update(used_pages)
+            for channel, text, append in messages:
+                if channel == 'header':
+                    self.message_on_header_widget(text)
+                else:
+                    self.message_on_detail_widget(text, append=True)
+            all_ok = all_ok and ok
+        return all_ok
+
+    def trim_caches(self):
+        self.store.trim_cache()
+        if self.incremental:
+            # The pages of the documents just built stay, even if they alone are more than PAGES_MAX_BYTES
+            trim_folder(join(self.input_folder, CACHE_FOLDER, 'pages'), PAGES_MAX_BYTES, self.used_pages)
+
+    def create_pdf(self, jobs=1):
+        # Create one PDF for each JSON file found, with jobs > 1 the documents are built concurrently. It returns True
+        # if all documents were created and all images could be read.
+        documents = self.prepare_build()
+        if len(documents) == 0:
+            return False
+        self.transcode_images()
 
+        if jobs > 1 and len(documents) > 1:
+            with ProcessPoolExecutor(min(jobs, len(documents))) as executor:
+                all_ok = self.collect_documents(self.submit_documents(executor, documents))
+        else:
+            # Documents are drawn one after the other, while the previous ones are compressed in other processes
+            all_ok = True
+            with ProcessPoolExecutor(COMPRESS_WORKERS) as self.compressor:
+                for setting_file, setting_file_suffix in documents:
+                    if self.cancel_requested:
+                        all_ok = False
+                        break
+                    all_ok = self.build_document(setting_file, setting_file_suffix) and all_ok
+                all_ok = self.finish_compressions() and all_ok
+            self.compressor = None
+        self.trim_caches()
+        self.message_on_detail_widget("Drag another folder to create a new one.")
+        return all_ok and len(self.unreadable_images) == 0
+
+    def check_document(self, setting_file, setting_file_suffix):
+        # Validates a setting file against the template and the images of the folder, without drawing anything
+        if not self.inizialize_pdf(setting_file, setting_file_suffix):
+            return False
 
-if __name__ == "__main__":
-    if GUI:
-        MainGUI()
+        with open(resource_path('settings.json'), 'r', encoding="utf8") as template:
+            missing = missing_settings(json.loads(template.read()), self.obj)
+        for key in missing:
+            self.message_on_detail_widget("Error: \"{}\" is missing {}.".format(setting_file, key))
+        if len(missing) > 0:
+            return False
+
+        if bool(self.obj['cover']['show']) and not 1 <= int(self.obj['cover']['use_image']) <= len(self.images):
+            self.message_on_detail_widget("Error: cover.use_image must be between 1 and {}.".format(len(self.images)))
+            return False
+
+        self.message_on_detail_widget("Info: \"{}\" is valid.".format(setting_file))
+        return True
+
+    def check_pdf(self):
+        # Dry run of create_pdf: settings and images are checked but no PDF is created
+        documents = self.prepare_build(create_default=False)
+        all_ok = len(documents) > 0
+        for setting_file, setting_file_suffix in documents:
+            all_ok = self.check_document(setting_file, setting_file_suffix) and all_ok
+        return all_ok and len(self.unreadable_images) == 0
+
+
+class MessageLog:
+    # Stands in for the Qt widgets in worker processes: messages are recorded and shown by the parent process
+
+    def __init__(self, channel, messages):
+        self.channel = channel
+        self.messages = messages
+
+    def setText(self, text):
+        self.messages.append((self.channel, text, False))
+
+    def append(self, text):
+        self.messages.append((self.channel, text, True))
+
+
+def missing_settings(template, obj, path=''):
+    # Keys of the template (but the comments) that are not in obj, like "grid.rows"
+    missing = []
+    for key, value in template.items():
+        if key.startswith('_'):
+            continue
+        if not isinstance(obj, dict) or key not in obj:
+            missing.append(path + key)
+        elif isinstance(value, dict):
+            missing.extend(missing_settings(value, obj[key], path + key + '.'))
+    return missing
+
+
+def build_document_in_worker(input_folder, setting_file, setting_file_suffix, images, index, captions, use_cache,
+                             stream_pages, incremental, profile):
+    messages = []
+    pdf = FotoPDF(input_folder, MessageLog('header', messages), MessageLog('detail', messages), use_cache=use_cache,
+                  stream_pages=stream_pages, incremental=incremental, profile=profile)
+    pdf.images = images
+    pdf.index = index
+    pdf.captions = captions
+    pdf.prepare_font_subset()
+    ok = pdf.build_document(setting_file, setting_file_suffix)
+    return ok, messages, pdf.used_pages
+
+
+def create_pdfs(input_folders, jobs=1, use_cache=True, only_languages=None, stream_pages=0, incremental=False,
+                profile=False):
+    # Build several folders at once: the documents of all the folders share the same pool of worker processes. It
+    # returns True if all documents of all folders were created.
+    pdfs = [FotoPDF([input_folder], None, use_cache=use_cache, only_languages=only_languages,
+                    stream_pages=stream_pages, incremental=incremental, profile=profile)
+            for input_folder in input_folders]
+    all_ok = True
+    with ProcessPoolExecutor(max(jobs, 1)) as executor:
+        pending = []
+        for pdf in pdfs:
+            documents = pdf.prepare_build()
+            if len(documents) > 0:
+                pdf.transcode_images()
+                pending.append((pdf, pdf.submit_documents(executor, documents)))
+            all_ok = all_ok and len(documents) > 0 and len(pdf.unreadable_images) == 0
+        for pdf, futures in pending:
+            all_ok = pdf.collect_documents(futures) and all_ok
+            pdf.trim_caches()
+    return all_ok
+
+
+def expand_input_folders(patterns):
+    # Folders (or any file in them) and glob patterns, like "exports/*", to a list of folders without duplicates
+    input_folders = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern), key=natural_keys) or [pattern]
+        for match in matches:
+            input_folder = dirname(abspath(match)) if isfile(match) else match
+            if input_folder not in input_folders:
+                input_folders.append(input_folder)
+    return input_folders
+
+
+def main(argv):
+    # Without arguments (or with the process serial number macOS passes to apps started from the Finder) the GUI is
+    # shown, otherwise FotoPDF runs headless and PySide2 is never imported
+    if len(argv) == 0 or argv[0].startswith('-psn'):
+        from gui import MainGUI
+        return MainGUI()
+
+    parser = argparse.ArgumentParser(prog="FotoPDF",
+                                     description="Create a presentation PDF from the images of a folder.")
+    parser.add_argument('input_folders', nargs='+', metavar='folder',
+                        help="folder containing the images and the settings, or any file in it")
+    parser.add_argument('--batch', action='store_true',
+                        help="process many folders, arguments can also be glob patterns like \"exports/*\"")
+    parser.add_argument('--jobs', type=int, default=1, metavar='N', help="number of documents built concurrently")
+    parser.add_argument('--only-lang', metavar='LANG',
+                        help="use only the setting files of these languages, comma separated (i.e. \"it,en\")")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="only check settings and images, no PDF is created")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="ignore the metadata cache stored in the folder and read all images again")
+    parser.add_argument('--stream', type=int, nargs='?', const=STREAM_PAGES, default=0, metavar='PAGES',
+                        help="write the PDF to disk every PAGES pages (default {}) to keep memory usage constant with "
+                             "very large folders".format(STREAM_PAGES))
+    parser.add_argument('--incremental', action='store_true',
+                        help="keep the pages in the cache folder and draw again only the ones whose images, captions "
+                             "or settings changed")
+    parser.add_argument('--profile', action='store_true',
+                        help="write next to each PDF the time spent in each stage, the slowest functions and the "
+                             "largest memory allocations")
+    parser.add_argument('--watch', action='store_true',
+                        help="keep running and create the PDFs of the folders (and their subfolders) again whenever "
+                             "their images or settings change")
+    args = parser.parse_args(argv)
+
+    if args.batch or args.watch:
+        input_folders = expand_input_folders(args.input_folders)
+    elif len(args.input_folders) == 1:
+        input_folders = [dirname(abspath(args.input_folders[0])) if isfile(args.input_folders[0])
+                         else args.input_folders[0]]
     else:
-        mypdf = FotoPDF(sys.argv[1:], None)
-        mypdf.create_pdf()
+        parser.error("use --batch to process more than one folder")
+
+    only_languages = None
+    if args.only_lang is not None:
+        only_languages = [language.strip().lower() for language in args.only_lang.split(',') if language.strip()]
+        unknown = [language for language in only_languages if language not in LANGUAGES]
+        if len(unknown) > 0:
+            parser.error("unknown language {}, use {}".format(", ".join(unknown), ", ".join(LANGUAGES)))
+
+    missing = [input_folder for input_folder in input_folders if not isdir(input_folder)]
+    for input_folder in missing:
+        print("Error: \"{}\" is not a folder.".format(input_folder))
+    input_folders = [input_folder for input_folder in input_folders if input_folder not in missing]
+
+    all_ok = len(missing) == 0
+    if args.watch:
+        from watch import watch
+        all_ok = watch(input_folders, jobs=args.jobs, use_cache=not args.no_cache,
+                       only_languages=only_languages) and all_ok
+    elif args.dry_run:
+        for input_folder in input_folders:
+            pdf = FotoPDF([input_folder], None, use_cache=not args.no_cache, only_languages=only_languages)
+            all_ok = pdf.check_pdf() and all_ok
+    elif len(input_folders) == 1:
+        pdf = FotoPDF(input_folders, None, use_cache=not args.no_cache, only_languages=only_languages,
+                      stream_pages=args.stream, incremental=args.incremental, profile=args.profile)
+        all_ok = pdf.create_pdf(jobs=args.jobs) and all_ok
+    elif len(input_folders) > 1:
+        all_ok = create_pdfs(input_folders, jobs=args.jobs, use_cache=not args.no_cache,
+                             only_languages=only_languages, stream_pages=args.stream,
+                             incremental=args.incremental, profile=args.profile) and all_ok
+    return 0 if all_ok else 1
+
+
+if __name__ == "__main__":
+    # Needed by the worker processes of the frozen app
+    multiprocessing.freeze_support()
+    sys.exit(main(sys.argv[1:]))
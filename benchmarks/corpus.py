@@ -0,0 +1,65 @@
+# Copyright Stefano Salati 2021
+
+# Synthetic image folders for the benchmarks: JPEG files with a caption in the ImageDescription field and a
+# settings.json made from the default template.
+
+import os
+import json
+import random
+import shutil
+from os.path import join, dirname, abspath
+
+ROOT = dirname(dirname(abspath(__file__)))
+
+
+def make_image(path, width, height, seed, caption=None, icc_profile=None, quality=90):
+    import PIL.Image
+    import PIL.ImageDraw
+
+    # A gradient with a few shapes on top: compresses like a photo more than flat colours or pure noise do
+    rnd = random.Random(seed)
+    im = PIL.Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    draw = PIL.ImageDraw.Draw(im)
+    for _ in range(40):
+        x, y = rnd.randrange(width), rnd.randrange(height)
+        r = rnd.randrange(width // 40 + 1, width // 6 + 2)
+        draw.ellipse((x - r, y - r, x + r, y + r),
+                     fill=(rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)))
+    exif = PIL.Image.Exif()
+    if caption is not None:
+        # ImageDescription is ASCII for Pillow, Lightroom writes UTF-8 bytes
+        exif[270] = caption.encode('utf-8')
+    kwargs = {'icc_profile': icc_profile} if icc_profile else {}
+    im.save(path, 'JPEG', quality=quality, exif=exif, **kwargs)
+
+
+def srgb_profile():
+    import PIL.ImageCms
+    return PIL.ImageCms.ImageCmsProfile(PIL.ImageCms.createProfile('sRGB')).tobytes()
+
+
+def make_corpus(folder, count, width=3000, height=2000, icc=True, languages=('it', 'en'), settings=None):
+    # Creates folder with count images and one setting file per language (a single settings.json if languages is
+    # empty). settings is a dictionary of changes to the template, like {"images": {"dpi": 0}}.
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+    icc_profile = srgb_profile() if icc else None
+    for i in range(count):
+        if len(languages) > 0:
+            caption = " ".join("#{} Didascalìa {} – {}.".format(language, i + 1, language) for language in languages)
+        else:
+            caption = "Didascalìa {}.".format(i + 1)
+        # One portrait every five images
+        w, h = (width, height) if i % 5 else (height, width)
+        make_image(join(folder, 'image {}.jpg'.format(i + 1)), w, h, i, caption, icc_profile)
+
+    with open(join(ROOT, 'settings.json'), 'r', encoding="utf8") as f:
+        obj = json.loads(f.read())
+    obj['fonts']['title'] = 'font_default.ttf'
+    for section, values in (settings or {}).items():
+        obj.setdefault(section, {}).update(values)
+    names = ['settings {}.json'.format(language) for language in languages] or ['settings.json']
+    for name in names:
+        with open(join(folder, name), 'w', encoding="utf8") as f:
+            json.dump(obj, f, indent=2)
+    return folder
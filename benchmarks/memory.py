@@ -0,0 +1,56 @@
+# Copyright Stefano Salati 2021
+
+# Peak memory (RSS) of FotoPDF versus the number of images, with the whole document in memory and in streaming mode.
+# Every build runs in a fresh process, images are embedded at their original resolution (dpi = 0) to make the
+# difference visible.
+#
+# Usage: python benchmarks/memory.py [counts...]
+
+import os
+import sys
+import json
+import tempfile
+import subprocess
+from os.path import join
+
+from corpus import ROOT, make_corpus
+
+# Runs FotoPDF in this process and prints its peak RSS in kB (Linux) or bytes (macOS)
+RUNNER = """
+import sys, resource, runpy
+sys.argv = sys.argv[1:]
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+except SystemExit:
+    pass
+print('RSS', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def peak_rss_mb(folder, extra_args):
+    output = subprocess.run([sys.executable, '-c', RUNNER, join(ROOT, 'FotoPDF.py'), folder, '--no-cache']
+                            + extra_args, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    rss = int([line for line in output.splitlines() if line.startswith('RSS ')][-1].split()[1])
+    return rss / (1024. * 1024.) if sys.platform == 'darwin' else rss / 1024.
+
+
+def main(counts):
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in counts:
+            folder = make_corpus(join(tmp, str(count)), count, 2400, 1600, languages=(),
+                                 settings={"images": {"dpi": 0}})
+            result = {'images': count,
+                      'in_memory_mb': peak_rss_mb(folder, []),
+                      'streaming_mb': peak_rss_mb(folder, ['--stream', '20'])}
+            results.append(result)
+            print("{:>6} images   in memory {:8.1f}MB   streaming {:8.1f}MB".format(count, result['in_memory_mb'],
+                                                                                    result['streaming_mb']))
+    return results
+
+
+if __name__ == "__main__":
+    results = main([int(arg) for arg in sys.argv[1:]] or [25, 50, 100, 200])
+    if os.environ.get('FOTOPDF_BENCH_JSON'):
+        with open(os.environ['FOTOPDF_BENCH_JSON'], 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,115 @@
+# Copyright Stefano Salati 2021
+
+# Throughput of FotoPDF on synthetic folders: time spent in each stage of the build, images per second, peak memory
+# (RSS) and size of the output. Every build runs in a fresh process without the caches of the folder, so results
+# don't depend on previous runs.
+#
+# Usage: python benchmarks/pipeline.py [--count N] [--size WxH] [--scenarios a,b] [--baseline results.json]
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+from os.path import join, abspath, getsize
+
+from corpus import ROOT, make_corpus
+
+# Stages timed by FotoPDF (see FotoPDF.Timings), in the order they are printed
+STAGES = ['index_images', 'header', 'hash', 'transcode_images', 'transcode', 'inizialize_pdf', 'cover_page',
+          'description_page', 'image_pages', 'prepare_image', 'resample', 'draw_image', 'wrap', 'grid_page',
+          'final_page', 'save_pdf', 'fix_colors', 'resave_pdf', 'compress']
+
+# Corpus options and settings of each scenario
+SCENARIOS = {
+    'default': {'corpus': {}, 'settings': {}},
+    'no-icc': {'corpus': {'icc': False}, 'settings': {}},
+    'one-language': {'corpus': {'languages': ()}, 'settings': {}},
+    'original-resolution': {'corpus': {}, 'settings': {"images": {"dpi": 0}}},
+    'no-thumbnails': {'corpus': {}, 'settings': {"grid": {"thumbnails": 0}}},
+}
+
+
+def run_build(folder):
+    # Runs in the child process: builds all the documents of folder and prints the results as JSON
+    import resource
+    sys.path.insert(0, ROOT)
+    import FotoPDF
+
+    start = time.perf_counter()
+    pdf = FotoPDF.FotoPDF([folder], None, use_cache=False)
+    sys.stdout = open(os.devnull, 'w')
+    ok = pdf.create_pdf()
+    sys.stdout = sys.__stdout__
+    total = time.perf_counter() - start
+    timings = dict((stage, seconds) for stage, (_, seconds) in pdf.timings.snapshot().items())
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    outputs = [f for f in os.listdir(folder) if f.endswith('.pdf')]
+    print(json.dumps({'ok': ok,
+                      'version': FotoPDF.VERSION,
+                      'images': len(pdf.images),
+                      'documents': len(outputs),
+                      'seconds': total,
+                      'stages': dict((stage, timings.get(stage, 0.)) for stage in STAGES),
+                      'peak_rss_mb': rss / (1024. * 1024.) if sys.platform == 'darwin' else rss / 1024.,
+                      'output_mb': sum(getsize(join(folder, f)) for f in outputs) / 1000000.}))
+
+
+def measure(folder):
+    output = subprocess.run([sys.executable, abspath(__file__), '--run', folder], stdout=subprocess.PIPE,
+                            universal_newlines=True, check=True).stdout
+    result = json.loads(output.splitlines()[-1])
+    # Each image is drawn once per document
+    result['images_per_second'] = result['images'] * result['documents'] / result['seconds']
+    return result
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Time each stage of FotoPDF on synthetic folders.")
+    parser.add_argument('--count', type=int, default=40, help="images per folder")
+    parser.add_argument('--size', default='3000x2000', help="size of the landscape images, like 3000x2000")
+    parser.add_argument('--scenarios', default=",".join(SCENARIOS), help="comma separated, among " +
+                        ", ".join(SCENARIOS))
+    parser.add_argument('--baseline', help="results of a previous run (see FOTOPDF_BENCH_JSON) to compare with")
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run:
+        run_build(args.run)
+        return []
+
+    width, height = (int(value) for value in args.size.lower().split('x'))
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = dict((result['scenario'], result) for result in json.load(f))
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in args.scenarios.split(','):
+            scenario = SCENARIOS[name]
+            folder = make_corpus(join(tmp, name), args.count, width, height, settings=scenario['settings'],
+                                 **scenario['corpus'])
+            result = measure(folder)
+            result.update({'scenario': name, 'count': args.count, 'size': [width, height]})
+            results.append(result)
+
+            line = "{:<20} {:6.1f} img/s {:8.1f}MB RSS {:7.1f}MB PDF".format(
+                name, result['images_per_second'], result['peak_rss_mb'], result['output_mb'])
+            if name in baseline:
+                line += "   {:+.0%} vs baseline".format(
+                    result['images_per_second'] / baseline[name]['images_per_second'] - 1)
+            print(line)
+            print("    " + "  ".join("{} {:.2f}s".format(stage, seconds)
+                                     for stage, seconds in result['stages'].items() if seconds > 0))
+    return results
+
+
+if __name__ == "__main__":
+    results = main(sys.argv[1:])
+    if results and os.environ.get('FOTOPDF_BENCH_JSON'):
+        with open(os.environ['FOTOPDF_BENCH_JSON'], 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,55 @@
+# Copyright Stefano Salati 2021
+
+# Startup time of FotoPDF: how long it takes to import the module (what every worker process pays) and to run the
+# command line up to the point where it starts working, compared with the cost of importing all the heavy
+# dependencies up front as FotoPDF used to do.
+#
+# Usage: python benchmarks/startup.py [runs]
+
+import os
+import sys
+import json
+import subprocess
+import time
+from os.path import join, dirname, abspath
+
+ROOT = dirname(dirname(abspath(__file__)))
+HEAVY = ['PIL.Image', 'exifread', 'reportlab.pdfgen.canvas', 'reportlab.platypus', 'reportlab.pdfbase.ttfonts',
+         'PySide2.QtWidgets', 'ghostscript']
+
+
+def best_of(runs, args):
+    # Best wall clock time of a fresh interpreter, the minimum is the least noisy estimate of a cold start
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(runs):
+    available = []
+    for module in HEAVY:
+        if subprocess.run([sys.executable, '-c', 'import ' + module], stderr=subprocess.DEVNULL).returncode == 0:
+            available.append(module)
+
+    results = {
+        'python': best_of(runs, ['-c', 'pass']),
+        'import FotoPDF': best_of(runs, ['-c', 'import FotoPDF']),
+        'FotoPDF.py --help': best_of(runs, [join(ROOT, 'FotoPDF.py'), '--help']),
+        'import heavy dependencies': best_of(runs, ['-c', 'import ' + ', '.join(available)]),
+        'heavy dependencies': available,
+    }
+    for key, value in results.items():
+        if isinstance(value, float):
+            print("{:<28}{:8.3f}s".format(key, value))
+    print("Heavy dependencies found: {}".format(", ".join(available)))
+    return results
+
+
+if __name__ == "__main__":
+    results = main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
+    if os.environ.get('FOTOPDF_BENCH_JSON'):
+        with open(os.environ['FOTOPDF_BENCH_JSON'], 'w') as f:
+            json.dump(results, f, indent=2)
@@ -15,6 +15,7 @@ pyinstaller --noconfirm --log-level=ERROR \
     --paths ~/PycharmProjects/FotoPDF/venv_3_6_5/lib/python3.6/site-packages/ \
     --add-data font_default.ttf:. \
     --add-data settings.json:. \
+    --add-data seed.pdf:. \
     --add-data FotoPDF.png:. \
     --icon FotoPDF.png \
     --hidden-import PySide2 \
@@ -0,0 +1,211 @@
+# Copyright Stefano Salati 2021
+
+# Qt user interface of FotoPDF. It's imported by FotoPDF.main() only when the app is launched without arguments, so
+# that the command line and the worker processes never load PySide2.
+
+import sys
+import threading
+from collections import deque
+from os.path import isfile, isdir
+# from PyQt5.QtWidgets import QApplication, QMainWindow, QTextEdit, QLineEdit
+# from PyQt5.QtGui import QIcon, QSyntaxHighlighter, QTextCharFormat, QColor
+# from PyQt5.QtCore import Qt
+from PySide2.QtWidgets import QApplication, QMainWindow, QTextEdit, QLineEdit, QProgressBar
+from PySide2.QtGui import QIcon, QSyntaxHighlighter, QTextCharFormat, QColor
+from PySide2.QtCore import Qt, QObject, QThread, Signal
+from FotoPDF import FotoPDF, resource_path, VERSION, MACOSRED, MACOSYELLOW, MACOSDARK
+
+# os.environ['QT_MAC_WANTS_LAYER'] = '1'
+# os.environ['QT_DEBUG_PLUGINS'] = '1'
+
+
+class MessageProxy(QObject):
+    # Stands in for a widget in the build thread: widgets can only be used by the GUI thread, signals are queued to it
+    text_set = Signal(str)
+    text_appended = Signal(str)
+
+    def __init__(self, widget):
+        super(MessageProxy, self).__init__()
+        self.text_set.connect(widget.setText)
+        if hasattr(widget, 'append'):
+            self.text_appended.connect(widget.append)
+
+    def setText(self, text):
+        self.text_set.emit(text)
+
+    def append(self, text):
+        self.text_appended.emit(text)
+
+
+class BuildThread(QThread):
+    # Creates the PDFs of the dropped folders one after the other, so that the window stays responsive
+    progress = Signal(object)
+
+    def __init__(self, header_widget, detail_widget):
+        super(BuildThread, self).__init__()
+        self.header_proxy = MessageProxy(header_widget)
+        self.detail_proxy = MessageProxy(detail_widget)
+        self.lock = threading.Lock()
+        self.queue = deque()
+        self.busy = False
+        self.pdf = None
+
+    def enqueue(self, path):
+        # It returns False if the folder has to wait for the ones dropped before
+        with self.lock:
+            self.queue.append(path)
+            if self.busy:
+                return False
+            self.busy = True
+        # The thread might still be returning from the previous run
+        self.wait()
+        self.start()
+        return True
+
+    def cancel(self):
+        # The current document stops at the end of the page being drawn, the queued folders are forgotten
+        with self.lock:
+            self.queue.clear()
+            if self.pdf is not None:
+                self.pdf.cancel()
+
+    def run(self):
+        while True:
+            with self.lock:
+                if len(self.queue) == 0:
+                    self.busy = False
+                    self.pdf = None
+                    return
+                path = self.queue.popleft()
+                self.pdf = FotoPDF(path, self.header_proxy, self.detail_proxy)
+                self.pdf.progress = self.progress.emit
+            try:
+                self.pdf.create_pdf()
+            except Exception as e:
+                # i.e. a setting file without some key: the error is shown and the next folders are built anyway
+                self.detail_proxy.append("Error: Cannot create the PDF of \"{}\" ({}: {}).".format(
+                    path, type(e).__name__, e))
+                self.pdf.discard_document()
+            finally:
+                with self.lock:
+                    self.pdf = None
+
+
+class FileEdit(QLineEdit):
+    def __init__(self, parent, detail_widget):
+        super(FileEdit, self).__init__(parent)
+        # Si usa solo nel caso del QLineEdit
+        # self.setDragEnabled(True)
+        self.detail_widget = detail_widget
+        self.builds = BuildThread(self, detail_widget)
+
+    def dragEnterEvent(self, event):
+        data = event.mimeData()
+        urls = data.urls()
+        if urls and urls[0].scheme() == 'file':
+            event.acceptProposedAction()
+
+    def dragMoveEvent(self, event):
+        data = event.mimeData()
+        urls = data.urls()
+        if urls and urls[0].scheme() == 'file':
+            event.acceptProposedAction()
+
+    def dropEvent(self, event):
+        data = event.mimeData()
+        urls = data.urls()
+        # Several folders can be dropped at once, or while another one is being built
+        for url in urls:
+            if url.scheme() != 'file':
+                continue
+            draggedpath = str(url.path())
+            if isfile(draggedpath) or isdir(draggedpath):
+                if not self.builds.enqueue(draggedpath):
+                    self.detail_widget.append("Info: \"{}\" queued.".format(draggedpath))
+            else:
+                self.setText("Invalid file or folder.")
+
+    def keyPressEvent(self, event):
+        if event.key() == Qt.Key_Escape and self.builds.busy:
+            self.detail_widget.append("Warning: Cancelling...")
+            self.builds.cancel()
+        else:
+            super(FileEdit, self).keyPressEvent(event)
+
+
+class Highlighter(QSyntaxHighlighter):
+    def __init__(self, parent):
+        super(Highlighter, self).__init__(parent)
+        self.infoFormat = QTextCharFormat()
+        self.infoFormat.setForeground(Qt.white)
+        self.infoFormat.setBackground(Qt.green)
+        self.warningFormat = QTextCharFormat()
+        self.warningFormat.setForeground(Qt.black)
+        # self.warningFormat.setBackground(Qt.yellow)
+        self.warningFormat.setBackground(QColor(MACOSYELLOW[0], MACOSYELLOW[1], MACOSYELLOW[2]))
+        self.errorFormat = QTextCharFormat()
+        self.errorFormat.setForeground(Qt.white)
+        self.errorFormat.setBackground(QColor(MACOSRED[0], MACOSRED[1], MACOSRED[2]))
+
+    def highlightBlock(self, text):
+        # uncomment this line for Python2
+        # text = unicode(text)
+        if text.startswith('Info'):
+            self.setFormat(0, len(text), self.infoFormat)
+        elif text.startswith('Warning'):
+            self.setFormat(0, len(text), self.warningFormat)
+        elif text.startswith('Error'):
+            self.setFormat(0, len(text), self.errorFormat)
+
+
+def MainGUI():
+    # app = QApplication(sys.argv)
+    app = QApplication([])
+    win = QMainWindow()
+    win.setGeometry(200, 200, 300, 600)
+    win.setFixedSize(300, 600)
+    win.setWindowTitle("FotoPDF" + " " + VERSION)
+    app.setWindowIcon(QIcon(resource_path('FotoPDF.png')))
+
+    detail_widget = QTextEdit(win)
+    detail_widget.setAlignment(Qt.AlignCenter)
+    highlighter = Highlighter(detail_widget.document())
+    detail_widget.setReadOnly(True)
+    detail_widget.setText("Tip: it works with "
+                          "both a folder or any file in that folder.")
+    detail_widget.setGeometry(0, 300, 300, 300)
+    detail_widget.setStyleSheet("background-color: rgb{}; color: rgb(255,255,255);".format(str(MACOSDARK)))
+
+    # Create widget to accept drag&drop
+    header_widget = FileEdit(win, detail_widget)
+    header_widget.setAlignment(Qt.AlignCenter)
+    header_widget.setReadOnly(True)
+    header_widget.setText("Drag folder here")
+    header_widget.setGeometry(0, 0, 300, 300)
+    font = header_widget.font()
+    font.setPointSize(32)
+    header_widget.setFont(font)
+    header_widget.setStyleSheet(
+        "background-color: rgb{}; color: rgb(255,255,255);border : 5px solid rgb{};".format(str(MACOSYELLOW),
+                                                                                            str(MACOSDARK)))
+
+    # Progress of the document being built, Esc cancels it
+    progress_widget = QProgressBar(win)
+    progress_widget.setGeometry(20, 250, 260, 24)
+    progress_widget.setAlignment(Qt.AlignCenter)
+    progress_widget.hide()
+
+    def show_progress(progress):
+        progress_widget.setMaximum(max(progress.pages_total, 1))
+        progress_widget.setValue(progress.pages_done)
+        progress_widget.setFormat("{}%v/%m pages, {:.1f}MB".format(
+            progress.image + ", " if progress.image is not None else "", progress.bytes_written / 1000000.))
+        progress_widget.setToolTip(progress.document)
+        progress_widget.setVisible(progress.pages_done < progress.pages_total)
+
+    header_widget.builds.progress.connect(show_progress)
+    header_widget.builds.finished.connect(progress_widget.hide)
+    app.aboutToQuit.connect(header_widget.builds.cancel)
+    app.aboutToQuit.connect(header_widget.builds.wait)
+    win.show()
+    sys.exit(app.exec_())
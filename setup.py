@@ -8,7 +8,7 @@ Usage:
 from setuptools import setup
 
 APP = ['FotoPDF.py']
-DATA_FILES = ['FotoPDF.png', 'font_default.ttf', "settings.json"]
+DATA_FILES = ['FotoPDF.png', 'font_default.ttf', "settings.json", "seed.pdf"]
 OPTIONS = {
     'packages': ['reportlab'],
     'argv_emulation': True,
@@ -0,0 +1,221 @@
+# Copyright Stefano Salati 2021
+
+# Watch mode of FotoPDF. It's imported by FotoPDF.main() only with --watch: the folders are monitored (with inotify
+# on Linux, polling elsewhere) and the PDFs are created again a few seconds after their images or settings change.
+
+import os
+import sys
+import time
+import errno
+import signal
+import select
+import struct
+import ctypes
+import ctypes.util
+from os.path import join, isdir, abspath
+from concurrent.futures import ProcessPoolExecutor
+from FotoPDF import FotoPDF, CACHE_FOLDER, INPUT_FORMATS
+
+# Seconds without changes before a folder is rebuilt, so that a whole export is waited for
+WATCH_DEBOUNCE = 3
+# Seconds between two scans of the folders when inotify is not available
+WATCH_POLL_INTERVAL = 2
+# Files that affect the PDFs, the PDFs themselves and the cache folder are ignored
+WATCH_EXTENSIONS = tuple(INPUT_FORMATS) + ('.json',)
+
+
+def relevant(filename):
+    return not filename.startswith('.') and filename.lower().endswith(WATCH_EXTENSIONS)
+
+
+def walk_folders(roots):
+    # All the folders below the roots, but the hidden ones (the cache folder among them)
+    for root in roots:
+        for folder, subfolders, _ in os.walk(root):
+            subfolders[:] = [f for f in subfolders if not f.startswith('.') and f != CACHE_FOLDER]
+            yield folder
+
+
+def has_images(folder):
+    return any(relevant(f) and f.lower().endswith(tuple(INPUT_FORMATS)) for f in os.listdir(folder))
+
+
+def project_folders(roots):
+    # Folders containing images, each one becomes one or more PDFs
+    return [folder for folder in walk_folders(roots) if has_images(folder)]
+
+
+class PollingWatcher:
+    # Compares size and modification time of the relevant files at every scan
+
+    def __init__(self, roots, interval=WATCH_POLL_INTERVAL):
+        self.roots = roots
+        self.interval = interval
+        self.state = self.scan()
+
+    def scan(self):
+        state = {}
+        for folder in walk_folders(self.roots):
+            try:
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        if entry.is_file() and relevant(entry.name):
+                            st = entry.stat()
+                            state[entry.path] = (st.st_size, st.st_mtime_ns)
+            except OSError:
+                pass
+        return state
+
+    def changes(self, timeout):
+        # Folders with created, modified or deleted files since the last call
+        time.sleep(min(timeout, self.interval))
+        state = self.scan()
+        changed = set(path for path in state.keys() | self.state.keys() if state.get(path) != self.state.get(path))
+        self.state = state
+        return set(os.path.dirname(path) for path in changed)
+
+
+class InotifyWatcher:
+    # Linux only, through libc, so no further dependency is needed
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, roots):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.folders = {}
+        for root in roots:
+            self.add_tree(root)
+
+    def add(self, folder):
+        # It returns False if the folder cannot be watched
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), self.MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            # A folder removed before it's watched (i.e. the temporary folders of an export) is just skipped
+            if error != errno.ENOENT:
+                print("Warning: Cannot watch \"{}\" ({}).".format(folder, os.strerror(error)))
+            return False
+        self.folders[wd] = folder
+        return True
+
+    def add_tree(self, top):
+        # Watches top and the folders below it, but the ones inside a folder that cannot be watched. It returns the
+        # folders watched.
+        added = []
+        skipped = []
+        for folder in walk_folders([top]):
+            if any(folder.startswith(parent + os.sep) for parent in skipped):
+                continue
+            if self.add(folder):
+                added.append(folder)
+            else:
+                skipped.append(folder)
+        return added
+
+    def changes(self, timeout):
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            folder = self.folders.get(wd)
+            if folder is None:
+                continue
+            if mask & self.IN_DELETE_SELF:
+                del self.folders[wd]
+            elif mask & self.IN_ISDIR:
+                # New folders (i.e. a new export) are watched as well, with their content
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO) and not name.startswith('.'):
+                    changed.update(self.add_tree(join(folder, name)))
+            elif relevant(name):
+                changed.add(folder)
+        return changed
+
+
+def make_watcher(roots):
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(roots)
+        except (OSError, AttributeError) as e:
+            print("Warning: inotify not available ({}), checking the folders every {} seconds.".format(
+                e, WATCH_POLL_INTERVAL))
+    return PollingWatcher(roots)
+
+
+def ignore_interrupts():
+    # Initializer of the worker processes: Ctrl+C stops the watch, which waits for the builds in progress, instead of
+    # interrupting the workers with a traceback each
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def watch(roots, jobs=1, use_cache=True, only_languages=None, debounce=WATCH_DEBOUNCE):
+    # Creates the PDFs of all folders below roots and then creates them again whenever they change, until interrupted.
+    # The worker processes live as long as the watch, so modules and fonts are loaded once, and the incremental mode
+    # reuses the metadata, the thumbnails and the pages of the previous builds.
+    roots = [abspath(root) for root in roots]
+    watcher = make_watcher(roots)
+    changed = dict((folder, 0) for folder in project_folders(roots))
+    building = {}
+    print("Watching {} ({} folders), press Ctrl+C to stop.".format(", ".join(roots), len(changed)))
+    with ProcessPoolExecutor(max(jobs, 1), initializer=ignore_interrupts) as executor:
+        try:
+            while True:
+                folders = watcher.changes(timeout=0.5)
+                now = time.time()
+                for folder in folders:
+                    changed[folder] = now
+
+                # Folders quiet for debounce seconds are built, unless a build of the same folder is still running: the
+                # change is kept and handled when it ends
+                for folder, last_change in list(changed.items()):
+                    if now - last_change < debounce or folder in building:
+                        continue
+                    del changed[folder]
+                    try:
+                        # New folders are watched as soon as they are created, but only the ones with images (i.e. not
+                        # the empty folder of an export that has just started) are built. No default settings are
+                        # written, the watch would otherwise create a settings.json in every new folder.
+                        if not isdir(folder) or not has_images(folder):
+                            continue
+                        pdf = FotoPDF([folder], None, use_cache=use_cache, only_languages=only_languages,
+                                      incremental=True)
+                        documents = pdf.prepare_build(create_default=False)
+                        if len(documents) > 0:
+                            pdf.transcode_images()
+                            building[folder] = (pdf, pdf.submit_documents(executor, documents))
+                    except Exception as e:
+                        # i.e. the folder has been removed meanwhile: the other folders are watched anyway
+                        print("Error: Cannot build \"{}\" ({}: {}).".format(folder, type(e).__name__, e))
+
+                for folder, (pdf, futures) in list(building.items()):
+                    if all(future.done() for future in futures):
+                        del building[folder]
+                        pdf.collect_documents(futures)
+                        pdf.trim_caches()
+        except KeyboardInterrupt:
+            # The documents not started yet are forgotten
+            for _, futures in building.values():
+                for future in futures:
+                    future.cancel()
+            print("Stopped watching.")
+    return True